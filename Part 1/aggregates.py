@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Single-pass aggregation engine for the monthly report
+
+Every metric of the report is computed from one set of integer codes per row (day,
+month, patient and an optional dimension such as the score zone). Counting is done
+with np.bincount over those codes, and distinct patients per month are counted by
+hashing the combined (month, patient) key once, so no per-patient intermediate
+frame and no second groupby are needed.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from periods import add_calendar, calendar_frame
+
+
+Report = namedtuple('Report', ['daily', 'monthly', 'patients', 'zones'])
+Report.__doc__ = '''
+Tidy tables all the report plots draw from
+    daily: 'date', 'Assessments Count'
+    monthly: 'period', 'Month Year', 'month', 'year', 'Assessments Count', 'Patients Count'
+    patients: 'patient_id', 'times_taken' (most frequent first)
+    zones: 'period', 'Month Year', 'month', 'year', <dimension name>, 'Zones Count' (None without a dimension)
+'''
+
+
+def aggregate(df, dimension=None, dimension_name=None):
+    '''
+    Input: assessments dataframe with a datetime64 'date' column, an optional
+           categorical dimension (column name or categorical series aligned with df)
+           and the name of the dimension column in the zones table (defaults to
+           the column name)
+    Output: Report with the daily, monthly, per-patient and per-dimension tables
+    '''
+    if 'period' not in df.columns:
+        add_calendar(df)
+
+    # Integer codes of every row, computed once
+    days = np.asarray(df['date'].values, dtype='datetime64[ns]').astype('datetime64[D]').astype('int64')
+    first_day = int(days.min()) if len(days) else 0
+    day_codes = days - first_day
+    month_codes = df['period'].cat.codes.values.astype(np.int64)
+    n_months = len(df['period'].cat.categories)
+    patient_codes, patient_ids = pd.factorize(df['patient_id'].values)
+    n_patients = max(len(patient_ids), 1)
+
+    # Daily assessments
+    daily_counts = np.bincount(day_codes)
+    observed_days = np.flatnonzero(daily_counts)
+    daily = pd.DataFrame({
+        'date': (observed_days + first_day).astype('datetime64[D]'),
+        'Assessments Count': daily_counts[observed_days],
+        })
+
+    # Monthly assessments and distinct patients
+    month_counts = np.bincount(month_codes, minlength=n_months)
+    month_patient = pd.unique(month_codes * n_patients + patient_codes)
+    month_patients = np.bincount(month_patient // n_patients, minlength=n_months)
+    observed_months = np.flatnonzero(month_counts)
+    monthly = calendar_frame(df, observed_months)
+    monthly['Assessments Count'] = month_counts[observed_months]
+    monthly['Patients Count'] = month_patients[observed_months]
+
+    # Assessments per patient, most frequent first
+    patients = pd.DataFrame({
+        'patient_id': patient_ids,
+        'times_taken': np.bincount(patient_codes, minlength=len(patient_ids)),
+        })
+    patients = patients.sort_values(['times_taken', 'patient_id'], ascending=[False, True], kind='stable')
+    patients.reset_index(drop=True, inplace=True)
+
+    # Monthly counts per dimension value
+    zones = None
+    if dimension is not None:
+        if isinstance(dimension, str):
+            dimension_name = dimension_name or dimension
+            dimension = df[dimension]
+        dimension_name = dimension_name or getattr(dimension, 'name', None) or 'dimension'
+        dimension = pd.Categorical(dimension)
+        n_values = len(dimension.categories)
+        # Rows with a missing dimension value (code -1) are left out of the counts
+        known = dimension.codes >= 0
+        counts = np.bincount(
+            month_codes[known] * n_values + dimension.codes[known], minlength=n_months * n_values
+            ).reshape(n_months, n_values)
+        month_idx, value_idx = np.nonzero(counts)
+        zones = calendar_frame(df, month_idx)
+        zones[dimension_name] = pd.Categorical.from_codes(value_idx, dtype=dimension.dtype)
+        zones['Zones Count'] = counts[month_idx, value_idx]
+
+    return Report(daily, monthly, patients, zones)
+
+
+def pivot_zones(zones, dimension='zone'):
+    '''
+    Input: zones table of a Report and the name of its dimension column
+    Output: dataframe indexed by (year, month) with a 'Month Year' column and one
+            count column per dimension value (0 when a month has no such result)
+    '''
+    pivot = zones.pivot(index=['year', 'month'], columns=dimension, values='Zones Count')
+    pivot = pivot.fillna(0).astype(np.int64).sort_index()
+    pivot.columns = pd.Index([str(column) for column in pivot.columns], name=dimension)
+    labels = zones.drop_duplicates(['year', 'month']).set_index(['year', 'month'])['Month Year']
+    pivot.insert(0, 'Month Year', labels.reindex(pivot.index).values)
+    return pivot
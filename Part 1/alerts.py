@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Red-zone alerting for the whole population
+
+Every patient is scored in one vectorized pass over the assessments sorted by
+(patient_id, date):
+
+*   rolling mean of each patient's last `window` scores, from a cumulative sum that
+    restarts at every patient (the same values as groupby('patient_id').rolling(),
+    without a Python call per patient);
+*   length of the current run of consecutive red-zone results;
+*   monthly share of the population's results in the red zone, against the 15-20%
+    benchmark of the analysis.
+
+An alert row is emitted when a patient's run of red-zone results reaches
+`min_streak`, when their rolling mean over a full window enters the red zone, and
+for every month whose red-zone share is above the benchmark. `since` limits the patient alerts to
+the new assessments (the history still feeds the windows), so an hourly run only
+reports what changed.
+
+Usage: python alerts.py DATA_PATH [--since 2020-07-01] [--window 3] [--min-streak 3]
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from banding import GAD7_ZONES
+from periods import month_index, month_label
+
+
+# Share of red-zone results considered normal (see "Grouped by 'score'" in the analysis)
+RED_SHARE_BENCHMARK = (0.15, 0.20)
+
+
+def patient_signals(df, bands=GAD7_ZONES, window=3):
+    '''
+    Input: assessments dataframe ('patient_id', 'date', 'score'), zone bands
+           (the last band is the red zone) and the rolling window in assessments
+    Output: dataframe of 'patient_id', 'date', 'score', 'sequence' (1 for the
+            patient's first assessment), 'rolling_mean' (mean of the patient's
+            last `window` scores, fewer at the start) and 'red_streak'
+            (consecutive red-zone results up to this one), sorted by patient and date
+    '''
+    order = np.lexsort((df['date'].values, df['patient_id'].values))
+    patient_ids = df['patient_id'].values[order]
+    scores = df['score'].values[order].astype(np.int64)
+    rows = np.arange(len(order))
+
+    # Row where each patient's records start
+    new_patient = np.r_[True, patient_ids[1:] != patient_ids[:-1]][:len(order)]
+    group_start = np.maximum.accumulate(np.where(new_patient, rows, 0))
+
+    # Rolling sum of the last `window` scores of the same patient
+    cumsum = np.r_[0, np.cumsum(scores)]
+    window_start = np.maximum(rows - window + 1, group_start)
+    rolling_mean = (cumsum[rows + 1] - cumsum[window_start]) / (rows + 1 - window_start)
+
+    # Consecutive red results: distance to the last non-red row (or the patient's first row)
+    red = scores >= bands.bounds[-1]
+    last_break = np.maximum.accumulate(np.where(red, -1, rows))
+    streak_start = np.maximum(last_break + 1, group_start)
+    red_streak = np.where(red, rows - streak_start + 1, 0)
+
+    return pd.DataFrame({
+        'patient_id': patient_ids,
+        'date': df['date'].values[order],
+        'score': df['score'].values[order],
+        'sequence': rows - group_start + 1,
+        'rolling_mean': rolling_mean,
+        'red_streak': red_streak,
+        })
+
+
+def patient_alerts(df, bands=GAD7_ZONES, window=3, min_streak=3, since=None):
+    '''
+    Input: assessments dataframe, zone bands, rolling window, number of consecutive
+           red-zone results that raises an alert and the first date to report
+           (None: everything)
+    Output: dataframe of 'date', 'patient_id', 'alert' ('red_streak' or
+            'rolling_mean'), 'value' and 'score', sorted by date
+    '''
+    signals = patient_signals(df, bands, window)
+    patient_ids = signals['patient_id'].values
+    same_patient = np.r_[False, patient_ids[1:] == patient_ids[:-1]]
+    # Only full windows: a single red result is not a red rolling mean
+    red_mean = (signals['rolling_mean'].values >= bands.bounds[-1]) & (signals['sequence'].values >= window)
+    entered = red_mean & ~(same_patient & np.r_[False, red_mean[:-1]])
+
+    triggers = {
+        'red_streak': (signals['red_streak'].values == min_streak, signals['red_streak'].values),
+        'rolling_mean': (entered, signals['rolling_mean'].values),
+    }
+    new = np.ones(len(signals), dtype=bool)
+    if since is not None:
+        new = signals['date'].values >= np.datetime64(pd.Timestamp(since))
+    frames = []
+    for alert, (fired, values) in triggers.items():
+        rows = np.flatnonzero(fired & new)
+        frames.append(pd.DataFrame({
+            'date': signals['date'].values[rows],
+            'patient_id': patient_ids[rows],
+            'alert': alert,
+            'value': values[rows].astype(np.float64),
+            'score': signals['score'].values[rows],
+            }))
+    alerts = pd.concat(frames, ignore_index=True)
+    alerts['alert'] = alerts['alert'].astype(pd.CategoricalDtype(list(triggers)))
+    return alerts.sort_values(['date', 'patient_id'], kind='stable', ignore_index=True)
+
+
+def red_share(df, bands=GAD7_ZONES, benchmark=RED_SHARE_BENCHMARK):
+    '''
+    Input: assessments dataframe ('date', 'score'), zone bands and the (low, high)
+           benchmark of the red-zone share
+    Output: dataframe with one row per month: 'period', 'Month Year',
+            'assessments', 'red', 'red_share' and 'alert' (share above the benchmark)
+    '''
+    months = month_index(df['date'])
+    first = int(months.min()) if len(months) else 0
+    codes = months - first
+    red = df['score'].values >= bands.bounds[-1]
+    assessments = np.bincount(codes)
+    red_counts = np.bincount(codes, weights=red, minlength=len(assessments)).astype(np.int64)
+    observed = np.flatnonzero(assessments)
+    periods = pd.PeriodIndex((observed + first).astype('datetime64[M]'), freq='M')
+    share = red_counts[observed] / assessments[observed]
+    return pd.DataFrame({
+        'period': periods,
+        'Month Year': [month_label(period) for period in periods],
+        'assessments': assessments[observed],
+        'red': red_counts[observed],
+        'red_share': share,
+        'alert': share > benchmark[1],
+        })
+
+
+def main():
+    from loader import load_assessments
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('data_path')
+    parser.add_argument('--since', default=None, help="only report patient alerts from this date")
+    parser.add_argument('--window', type=int, default=3)
+    parser.add_argument('--min-streak', type=int, default=3)
+    args = parser.parse_args()
+
+    df = load_assessments(args.data_path)
+    start = time.perf_counter()
+    alerts = patient_alerts(df, window=args.window, min_streak=args.min_streak, since=args.since)
+    shares = red_share(df)
+    print(f"{len(df):,} assessments scored in {time.perf_counter() - start:.3f}s")
+    print(alerts['alert'].value_counts().to_string())
+    print(shares[shares['alert']].to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
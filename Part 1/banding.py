@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Score banding for assessment instruments
+
+A band set is a list of lower bounds and labels, e.g. the GAD-7 'red zone' starts at
+a score of 10. The bounds are expanded once into a lookup array indexed by score, so
+banding a column is a single vectorized take, and the result is stored as a
+categorical (one byte per row) in a new column next to 'score'.
+
+Other instruments plug in by creating their own Bands and, optionally, registering
+them in INSTRUMENT_BANDS.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class Bands:
+    '''
+    Score bands of an instrument
+    Input: name of the column to create, lower bound of each band (ascending,
+           starting at the lowest possible score), band labels and the highest
+           possible score
+    Example: Bands('zone', [0, 10], ['safe_zone', 'red_zone'], max_score=21)
+             -> 0-9: 'safe_zone', 10-21: 'red_zone'
+    '''
+
+    def __init__(self, name, bounds, labels, max_score):
+        if len(bounds) != len(labels):
+            raise ValueError(f"{name}: got {len(bounds)} bounds for {len(labels)} labels")
+        if list(bounds) != sorted(set(bounds)):
+            raise ValueError(f"{name}: bounds must be strictly increasing, got {list(bounds)}")
+        if bounds[-1] > max_score:
+            raise ValueError(f"{name}: bound {bounds[-1]} is above the highest score {max_score}")
+        self.name = name
+        self.bounds = list(bounds)
+        self.labels = list(labels)
+        self.min_score = self.bounds[0]
+        self.max_score = max_score
+        self.dtype = pd.CategoricalDtype(self.labels, ordered=True)
+        # Band code of every score from 0 to max_score, -1 below the first bound
+        self.lookup = (np.searchsorted(self.bounds, np.arange(max_score + 1), side='right') - 1).astype(np.int8)
+
+    def __repr__(self):
+        return f"Bands({self.name!r}, {self.bounds}, {self.labels}, max_score={self.max_score})"
+
+    def cut(self, scores):
+        '''
+        Input: array or series of integer scores
+        Output: categorical of band labels, missing for scores out of range
+        '''
+        scores = np.asarray(scores)
+        in_range = (scores >= self.min_score) & (scores <= self.max_score)
+        codes = np.full(scores.shape, -1, dtype=np.int8)
+        codes[in_range] = self.lookup[scores[in_range].astype(np.intp)]
+        return pd.Categorical.from_codes(codes, dtype=self.dtype)
+
+
+# GAD-7: a score of 10 or above needs further clinical evaluation ('red zone')
+GAD7_ZONES = Bands('zone', [0, 10], ['safe_zone', 'red_zone'], max_score=21)
+GAD7_SEVERITY = Bands(
+    'severity', [0, 6, 11, 16], ['low_to_minimal', 'mild', 'moderate', 'severe'], max_score=21
+    )
+
+# PHQ-9
+PHQ9_ZONES = Bands('zone', [0, 10], ['safe_zone', 'red_zone'], max_score=27)
+PHQ9_SEVERITY = Bands(
+    'severity', [0, 5, 10, 15, 20],
+    ['minimal', 'mild', 'moderate', 'moderately_severe', 'severe'], max_score=27
+    )
+
+# Band sets per assessment type, as found in the 'type' column
+INSTRUMENT_BANDS = {
+    'gad7': [GAD7_ZONES, GAD7_SEVERITY],
+    'phq9': [PHQ9_ZONES, PHQ9_SEVERITY],
+}
+
+
+def add_bands(df, bands, score_column='score'):
+    '''
+    Input: assessments dataframe, Bands (or list of Bands) and the score column
+    Output: the same dataframe with one categorical column per band set added in place
+    Example: add_bands(df, GAD7_ZONES) -> new 'zone' column, 'score' is left untouched
+    '''
+    if isinstance(bands, Bands):
+        bands = [bands]
+    scores = df[score_column].values
+    for band in bands:
+        df[band.name] = band.cut(scores)
+    return df
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for the Part 1 analysis pipeline
+
+The pipeline benchmark times and memory-profiles every stage of the analysis on
+synthetic GAD-7 data (see synthetic.py) at 100k, 1M and 10M rows. Results can be
+saved as JSON and compared with a previous run to catch regressions. The other
+benchmarks compare one optimized stage against the way the original script did it.
+
+Usage: python benchmarks.py pipeline [--sizes 100000 1000000] [--json out.json] [--baseline old.json]
+       python benchmarks.py {banding,calendar,parsing,report} --rows 10000000
+"""
+
+import argparse
+import calendar
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from aggregates import aggregate
+from banding import GAD7_SEVERITY, GAD7_ZONES, add_bands
+from loader import add_time_columns, load_assessments, parse_timestamps
+from periods import MONTH_KEYS, add_calendar
+from pipeline import Stage, analysis_stages, run_stages
+from validation import read_checked
+from synthetic import generate_assessments, write_csv
+
+
+PIPELINE_SIZES = [100_000, 1_000_000, 10_000_000]
+
+# Smallest stage time and traced peak the regression gate compares: below these,
+# scheduler and allocator noise is larger than the tolerance
+MIN_SECONDS = 0.05
+MIN_PEAK_MB = 1.0
+
+
+def legacy_calendar(df):
+    '''
+    Input: dataframe with a 'date' column
+    Output: monthly assessment counts computed the way the original script did
+    '''
+    temp_df = df.copy()
+    temp_df['year'] = pd.DatetimeIndex(temp_df['date']).year
+    temp_df['month'] = pd.DatetimeIndex(temp_df['date']).month
+    temp_df['month name'] = temp_df['month'].apply(lambda x: calendar.month_abbr[x])
+    temp_df['Month Year'] = temp_df['month name'] + ' ' + temp_df['year'].astype('str')
+    return temp_df.groupby(MONTH_KEYS).size()
+
+
+def shared_calendar(df):
+    '''
+    Input: dataframe with a 'date' column
+    Output: monthly assessment counts computed from the shared calendar stage
+    '''
+    add_calendar(df)
+    return df.groupby(MONTH_KEYS, observed=True).size()
+
+
+def legacy_report(df):
+    '''
+    Input: assessments dataframe
+    Output: the report tables computed with one groupby per metric, as the original script did
+    '''
+    temp_df = df.copy()
+    temp_df['year'] = temp_df['date'].dt.year
+    temp_df['month'] = temp_df['date'].dt.month
+    temp_df['zone'] = np.where(temp_df['score'] >= 10, 'red_zone', 'safe_zone')
+    daily = temp_df.groupby(temp_df['date'].dt.date).size()
+    monthly = temp_df.groupby(['year', 'month']).size()
+    patient_month = temp_df.groupby(['year', 'month', 'patient_id']).size().reset_index()
+    patients_monthly = patient_month.groupby(['year', 'month']).size()
+    patients = temp_df.groupby('patient_id').size().sort_values(ascending=False)
+    zones = temp_df.groupby(['year', 'month', 'zone']).size()
+    return daily, monthly, patients_monthly, patients, zones
+
+
+def engine_report(df):
+    '''
+    Input: assessments dataframe
+    Output: the report tables computed by the single-pass aggregation engine, calendar
+            stage included (the legacy report derives its year and month too)
+    '''
+    add_calendar(df)
+    add_bands(df, GAD7_ZONES)
+    return aggregate(df, dimension='zone')
+
+
+def legacy_banding(df):
+    '''
+    Input: assessments dataframe
+    Output: zone and severity frames built with full copies and dict maps, as the original script did
+    '''
+    df_two = df.copy()
+    df_two['score'] = df_two['score'].map({score: 'red_zone' if score >= 10 else 'safe_zone' for score in range(22)})
+    df_four = df.copy()
+    df_four['score'] = df_four['score'].map(
+        {score: GAD7_SEVERITY.labels[GAD7_SEVERITY.lookup[score]] for score in range(22)}
+        )
+    return df_two, df_four
+
+
+def banded(df):
+    '''
+    Input: assessments dataframe
+    Output: the same dataframe with categorical 'zone' and 'severity' columns
+    '''
+    return add_bands(df, [GAD7_ZONES, GAD7_SEVERITY])
+
+
+def legacy_parsing(raw):
+    '''
+    Input: series of raw ISO timestamp strings
+    Output: 'date' and 'date_hms' string columns built per row, as the original script did
+    '''
+    date = raw.apply(lambda x: x.replace('T', ' ')[:19])
+    date_hms = date.apply(lambda x: x.replace('T', ' ')[:10])
+    return pd.DataFrame({'date': date, 'date_hms': date_hms})
+
+
+def vectorized_parsing(raw):
+    '''
+    Input: series of raw ISO timestamp strings
+    Output: datetime64 'date' (truncated to the second) and 'date_hms' (day) columns
+    '''
+    return add_time_columns(pd.DataFrame({'date': parse_timestamps(raw)}))
+
+
+def pipeline_stages(path, cache_dir):
+    '''
+    Input: path to a raw CSV export and a directory for the Parquet cache
+    Output: list of the analysis Stages, loading the CSV once without and once with the cache
+    '''
+    def load(state):
+        state['df'] = read_checked(path, cache=False)
+        return state
+
+    stages = analysis_stages(path, cache_dir=cache_dir)
+    return [Stage('load', load, None, 'df'), stages[0]._replace(name='load (cached)')] + stages[1:]
+
+
+def run_pipeline(rows, seed=0, repeat=3):
+    '''
+    Input: number of synthetic assessments, random seed and number of runs
+    Output: list of dicts with the best wall time (s) and peak traced memory (MB) of
+            every stage over the runs
+    '''
+    best = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'phq_all_final.csv')
+        write_csv(generate_assessments(rows, seed), path)
+        cache_dir = os.path.join(tmp, 'cache')
+        # Write the cache once so the cached load measures a warm read
+        load_assessments(path, cache_dir=cache_dir)
+        # Import matplotlib up front so the plotting stage measures drawing only
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot  # noqa: F401
+
+        for _ in range(repeat):
+            _, records = run_stages(pipeline_stages(path, cache_dir), trace_memory=True)
+            for record in records:
+                result = best.setdefault(record['stage'], {
+                    'rows': rows, 'stage': record['stage'], 'seconds': float('inf'), 'peak_mb': float('inf'),
+                    })
+                result['seconds'] = min(result['seconds'], round(record['wall_seconds'], 4))
+                result['peak_mb'] = min(result['peak_mb'], record['traced_peak_mb'])
+    return list(best.values())
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Input: pipeline results, results of a previous run and the allowed slowdown (0.2 = 20%)
+    Output: list of messages, one per stage that got slower or bigger than the tolerance
+    '''
+    previous = {(r['rows'], r['stage']): r for r in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get((result['rows'], result['stage']))
+        if old is None:
+            continue
+        for metric in ['seconds', 'peak_mb']:
+            # Ignore noise on stages too small to measure reliably
+            floor = MIN_SECONDS if metric == 'seconds' else MIN_PEAK_MB
+            if result[metric] > max(old[metric], floor) * (1 + tolerance):
+                regressions.append(
+                    f"{result['stage']} at {result['rows']:,} rows: {metric} {old[metric]} -> {result[metric]}"
+                    )
+    return regressions
+
+
+def timed(func, *args, repeat=3):
+    '''
+    Input: function, its arguments and the number of repetitions
+    Output: (best wall time in seconds, result of the last call)
+    '''
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_pipeline(sizes, json_path=None, baseline_path=None, tolerance=0.2, repeat=3):
+    results = []
+    for rows in sizes:
+        print(f"pipeline, {rows:,} rows, best of {repeat}")
+        for result in run_pipeline(rows, repeat=repeat):
+            print(f"  {result['stage']:<15} {result['seconds']:>9.3f}s {result['peak_mb']:>10.1f} MB peak")
+            results.append(result)
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return not regressions
+    return True
+
+
+def bench_calendar(rows, repeat=3):
+    df = generate_assessments(rows)[['date']]
+    legacy_time, _ = timed(legacy_calendar, df, repeat=repeat)
+    shared_time, _ = timed(shared_calendar, df, repeat=repeat)
+    print(f"calendar stage, {rows:,} rows")
+    print(f"  legacy (copy + apply + string concat): {legacy_time:.3f}s")
+    print(f"  shared calendar stage:                 {shared_time:.3f}s ({legacy_time / shared_time:.1f}x)")
+
+
+def bench_report(rows, repeat=3):
+    df = generate_assessments(rows)
+    legacy_time, _ = timed(legacy_report, df, repeat=repeat)
+    engine_time, _ = timed(engine_report, df, repeat=repeat)
+    print(f"report aggregation, {rows:,} rows")
+    print(f"  one groupby per metric:   {legacy_time:.3f}s")
+    print(f"  single-pass engine:       {engine_time:.3f}s ({legacy_time / engine_time:.1f}x)")
+
+
+def bench_banding(rows, repeat=3):
+    df = generate_assessments(rows)
+    legacy_time, (df_two, df_four) = timed(legacy_banding, df, repeat=repeat)
+    legacy_bytes = df_two['score'].memory_usage(deep=True) + df_four['score'].memory_usage(deep=True)
+    del df_two, df_four
+    bands_time, df = timed(banded, df, repeat=repeat)
+    bands_bytes = df['zone'].memory_usage(deep=True) + df['severity'].memory_usage(deep=True)
+    print(f"score banding, {rows:,} rows")
+    print(f"  copies + dict map:  {legacy_time:.3f}s, {legacy_bytes / rows:.1f} bytes/row for the labels")
+    print(f"  lookup array:       {bands_time:.3f}s ({legacy_time / bands_time:.1f}x), "
+          f"{bands_bytes / rows:.1f} bytes/row for the labels")
+
+
+def bench_parsing(rows, repeat=3):
+    raw = generate_assessments(rows)['date'].dt.strftime('%Y-%m-%dT%H:%M:%S.%f')
+    legacy_time, _ = timed(legacy_parsing, raw, repeat=repeat)
+    parsing_time, _ = timed(vectorized_parsing, raw, repeat=repeat)
+    print(f"timestamp parsing, {rows:,} rows")
+    print(f"  convert_date/convert_date_hms apply: {legacy_time:.3f}s ({rows / legacy_time / 1e6:.1f}M rows/s)")
+    print(f"  vectorized parse + floor/normalize:  {parsing_time:.3f}s ({rows / parsing_time / 1e6:.1f}M rows/s, "
+          f"{legacy_time / parsing_time:.1f}x)")
+
+
+BENCHMARKS = {
+    'banding': bench_banding,
+    'calendar': bench_calendar,
+    'parsing': bench_parsing,
+    'report': bench_report,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmark', choices=['pipeline'] + sorted(BENCHMARKS))
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--sizes', type=int, nargs='+', default=PIPELINE_SIZES)
+    parser.add_argument('--json', help="save the pipeline results to this file")
+    parser.add_argument('--baseline', help="compare the pipeline results with this file")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+    if args.benchmark == 'pipeline':
+        if not bench_pipeline(args.sizes, args.json, args.baseline, args.tolerance, args.repeat):
+            sys.exit(1)
+    else:
+        BENCHMARKS[args.benchmark](args.rows, repeat=args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Per-patient score charts, rendered in batch
+
+Every chart plots a patient's scores on a real datetime axis (automatic locator and
+concise date labels) with the patient's mean as a dashed line, the same chart the
+script draws for its top 3 patients. Batches are rendered in a process pool with
+the Agg backend; each worker only receives the dates and scores of the patients
+it draws.
+
+Usage: python charts.py DATA_PATH OUT_DIR [--top N | --patients ID [ID ...]] [--format svg]
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from history_file import PatientHistory
+from patient_index import PatientIndex
+
+
+SCORE_COLOR = '#A1CCC3'
+MEAN_COLOR = '#05261e'
+
+
+def plot_scores(ax, dates, scores, patient_id):
+    '''
+    Input: matplotlib axes, datetime64 array of assessment dates, array of scores and the patient id
+    Output: the axes with the scores, their mean and the labels drawn
+    '''
+    import matplotlib.dates as mdates
+
+    dates = np.asarray(dates, dtype='datetime64[ns]')
+    ax.plot(dates, scores, color=SCORE_COLOR, label='Score')
+    if len(scores):
+        ax.axhline(np.mean(scores), label='Mean', linestyle='--', color=MEAN_COLOR)
+        first, last = dates[0].astype('datetime64[D]').item(), dates[-1].astype('datetime64[D]').item()
+        ax.set_title(f"Scores of Patient {patient_id} from {first:%B} {first.day}, {first.year} "
+                     f"to {last:%B} {last.day}, {last.year}")
+    else:
+        ax.set_title(f"Scores of Patient {patient_id} (no assessments)")
+    locator = mdates.AutoDateLocator()
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+    ax.set_xlabel("Date", size=12)
+    ax.set_ylabel("Score", size=12)
+    ax.legend(loc='upper right')
+    ax.autoscale(tight=False)
+    return ax
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _render(task):
+    '''
+    Input: (patient id, dates, scores, output path)
+    Output: output path
+    '''
+    import matplotlib.pyplot as plt
+
+    patient_id, dates, scores, path = task
+    fig, ax = plt.subplots(1, 1, figsize=(15, 8))
+    plot_scores(ax, dates, scores, patient_id)
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+    return path
+
+
+def render_patient_charts(patients, out_dir, patient_ids=None, top=None, fmt='png', workers=None):
+    '''
+    Input: PatientIndex or PatientHistory (or assessments dataframe), output directory, the patient
+           ids to draw or the number of most frequent test takers, the image
+           format ('png' or 'svg') and the number of worker processes
+           (None: one per CPU, 0: render in this process)
+    Output: list of written file paths, in the order of the patients
+    '''
+    if not isinstance(patients, (PatientIndex, PatientHistory)):
+        patients = PatientIndex(patients)
+    if patient_ids is None:
+        if top is None:
+            raise ValueError("Either patient_ids or top is required")
+        patient_ids = patients.top(top)
+    os.makedirs(out_dir, exist_ok=True)
+
+    tasks = []
+    for patient_id in patient_ids:
+        records = patients.get(patient_id)
+        tasks.append((
+            patient_id, records['date'].values, records['score'].values,
+            os.path.join(out_dir, f"patient_{patient_id}.{fmt}"),
+            ))
+
+    if workers == 0:
+        _init_worker()
+        return [_render(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        chunksize = max(1, len(tasks) // (4 * (workers or os.cpu_count() or 1)))
+        return list(pool.map(_render, tasks, chunksize=chunksize))
+
+
+def main():
+    from loader import load_assessments
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('data_path')
+    parser.add_argument('out_dir')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--top', type=int, help="draw the N patients with the most assessments")
+    group.add_argument('--patients', type=int, nargs='+', help="draw these patient ids")
+    parser.add_argument('--format', default='png', choices=['png', 'svg'])
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    patients = PatientIndex(load_assessments(args.data_path)[['patient_id', 'date', 'score']])
+    paths = render_patient_charts(
+        patients, args.out_dir, patient_ids=args.patients, top=args.top, fmt=args.format, workers=args.workers
+        )
+    print(f"{len(paths)} charts written to {args.out_dir}")
+
+
+if __name__ == '__main__':
+    main()
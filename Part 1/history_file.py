@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""Memory-mapped patient history file
+
+One binary file holds every patient's assessments, sorted by (patient_id, date),
+so that dashboard workers can open it with np.memmap instead of each parsing the
+CSV: all the processes share the page-cached copy, and a patient's history is a
+slice of the record array located through the offsets index.
+
+Layout (little-endian, every section 8-byte aligned):
+
+    header      64 bytes   MAGIC, number of patients, number of records
+    offsets     int64      patients + 1 entries, records of patient i are
+                           records[offsets[i]:offsets[i + 1]]
+    ids         int32      patients entries, sorted (padded to 8 bytes)
+    records     RECORD     fixed-width records, 18 bytes each
+
+Usage: python history_file.py DATA_PATH OUT_PATH
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from store import ASSESSMENT_TYPES, TIME_UNIT, AssessmentStore
+
+
+MAGIC = b'PHIST001'
+
+HEADER_SIZE = 64
+
+HEADER = np.dtype([('magic', 'S8'), ('patients', '<u8'), ('records', '<u8')])
+
+RECORD = np.dtype([
+    ('date', '<i8'),
+    ('patient_date_created', '<i8'),
+    ('score', 'u1'),
+    ('type', 'i1'),
+])
+
+
+def _align(size):
+    return (size + 7) // 8 * 8
+
+
+def _sections(patients):
+    '''
+    Input: number of patients
+    Output: byte offsets of the (offsets, ids, records) sections
+    '''
+    offsets = HEADER_SIZE
+    ids = offsets + 8 * (patients + 1)
+    records = ids + _align(4 * patients)
+    return offsets, ids, records
+
+
+def write_history(data, path):
+    '''
+    Input: assessments dataframe or AssessmentStore, output path
+    Output: number of patients written; the file is replaced atomically
+    '''
+    store = data if isinstance(data, AssessmentStore) else AssessmentStore.from_frame(data)
+    order = np.lexsort((store.date, store.patient_id))
+    sorted_ids = store.patient_id[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]][:len(sorted_ids)])
+    ids = sorted_ids[starts]
+    offsets = np.append(starts, len(sorted_ids)).astype('<i8')
+
+    records = np.empty(len(order), dtype=RECORD)
+    for field in RECORD.names:
+        records[field] = getattr(store, field)[order]
+
+    header = np.zeros(1, dtype=HEADER)
+    header[0] = (MAGIC, len(ids), len(records))
+    offsets_at, ids_at, records_at = _sections(len(ids))
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(header.tobytes().ljust(HEADER_SIZE, b'\0'))
+        f.write(offsets.tobytes())
+        f.write(ids.astype('<i4').tobytes().ljust(records_at - ids_at, b'\0'))
+        f.write(records.tobytes())
+    os.replace(tmp, path)
+    return len(ids)
+
+
+class PatientHistory:
+    '''
+    Read-only view of a patient history file, shared by the processes that open it
+    Input: path written by write_history
+    Example: history = PatientHistory('phq_history.bin')
+             history.records(10687) -> memmap slice of the patient's records
+             history.get(10687) -> dataframe with 'date' and 'score', sorted by date
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._map = np.memmap(path, dtype=np.uint8, mode='r')
+        if len(self._map) < HEADER_SIZE:
+            raise ValueError(f"{path} is not a patient history file")
+        header = self._map[:HEADER.itemsize].view(HEADER)[0]
+        if header['magic'] != MAGIC:
+            raise ValueError(f"{path} is not a patient history file")
+        patients, count = int(header['patients']), int(header['records'])
+        offsets_at, ids_at, records_at = _sections(patients)
+        if len(self._map) != records_at + count * RECORD.itemsize:
+            raise ValueError(f"{path} is truncated")
+        # Plain ndarray views of the mapping (no memmap subclass overhead on every slice)
+        buffer = np.asarray(self._map)
+        self.offsets = buffer[offsets_at:ids_at].view('<i8')
+        self.ids = buffer[ids_at:ids_at + 4 * patients].view('<i4')
+        self.all_records = buffer[records_at:].view(RECORD)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, patient_id):
+        return self.position(patient_id) >= 0
+
+    def positions(self, patient_ids):
+        '''
+        Input: array-like of patient ids
+        Output: position of each patient in self.ids, -1 for unknown patients
+        '''
+        patient_ids = np.asarray(patient_ids, dtype=np.int64)
+        # Search with the ids' own dtype, so numpy does not convert the whole mapped array
+        limits = np.iinfo(self.ids.dtype)
+        valid = (patient_ids >= limits.min) & (patient_ids <= limits.max)
+        result = np.searchsorted(self.ids, np.where(valid, patient_ids, 0).astype(self.ids.dtype))
+        found = valid & (result < len(self.ids))
+        found[found] = self.ids[result[found]] == patient_ids[found]
+        return np.where(found, result, -1)
+
+    def position(self, patient_id):
+        # Scalar binary search: a dashboard lookup stays in the microseconds
+        if not -2**31 <= patient_id < 2**31:
+            return -1
+        pos = int(self.ids.searchsorted(np.int32(patient_id)))
+        if pos < len(self.ids) and self.ids[pos] == patient_id:
+            return pos
+        return -1
+
+    def records(self, patient_id):
+        '''
+        Input: patient id
+        Output: slice of the mapped records of the patient sorted by date (RECORD dtype,
+                dates in microseconds since the epoch), empty for an unknown patient
+        '''
+        pos = self.position(patient_id)
+        if pos < 0:
+            return self.all_records[:0]
+        return self.all_records[self.offsets[pos]:self.offsets[pos + 1]]
+
+    def get(self, patient_id):
+        '''
+        Input: patient id
+        Output: dataframe of the patient's assessments sorted by date, with the
+                loader's columns and dtypes
+        '''
+        records = self.records(patient_id)
+        return pd.DataFrame({
+            'date': records['date'].view(f'datetime64[{TIME_UNIT}]'),
+            'patient_id': np.full(len(records), patient_id, dtype=np.int32),
+            'type': pd.Categorical.from_codes(records['type'], categories=ASSESSMENT_TYPES),
+            'patient_date_created': records['patient_date_created'].view(f'datetime64[{TIME_UNIT}]'),
+            'score': records['score'],
+            })
+
+    def counts(self):
+        '''
+        Output: series with the number of records per patient, indexed by patient id
+        '''
+        return pd.Series(np.diff(self.offsets), index=pd.Index(self.ids, name='patient_id'), name='times_taken')
+
+    def top(self, n):
+        '''
+        Input: number of patients
+        Output: ids of the n patients with the most records (ties by lowest id)
+        '''
+        order = np.lexsort((self.ids, -np.diff(self.offsets)))
+        return self.ids[order[:n]].tolist()
+
+
+def main():
+    from loader import load_assessments
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('data_path')
+    parser.add_argument('out_path')
+    args = parser.parse_args()
+    patients = write_history(load_assessments(args.data_path), args.out_path)
+    print(f"{patients:,} patients, {os.path.getsize(args.out_path):,} bytes written to {args.out_path}")
+
+
+if __name__ == '__main__':
+    main()
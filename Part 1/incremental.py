@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""Incremental refresh of the report aggregates
+
+The running counts of streaming.StreamingAggregator are saved in a state directory,
+together with a watermark per source file: the byte offset up to which the file has
+been ingested. A refresh only parses the bytes appended since the last run (or the
+partition files that are new), so its cost depends on the size of the delta and not
+on the size of the history. The watermark also keeps the file's header, used to read
+every later delta, and a hash of its first bytes: a file rewritten in place of the
+one ingested is refused (run with --rebuild) instead of being read from an offset
+that no longer falls on a line boundary.
+
+Late-arriving rows (dated before the latest assessment already ingested) need no
+special handling: counts are indexed by calendar day and month, and the distinct
+(month, patient) keys are part of the state, so a late row updates the right period
+and is never double counted as a new patient. They are reported in the refresh summary.
+
+A refresh that finds nothing new leaves the state untouched: its version (the key of
+the results cached by result_cache.py) only changes with the data.
+
+Usage: python incremental.py STATE_DIR SOURCE [SOURCE ...] [--rebuild]
+"""
+
+import argparse
+import glob
+import hashlib
+import io
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from aggregates import pivot_zones
+from banding import GAD7_ZONES
+from loader import COLUMNS, RAW_SCHEMA, narrow_types, parse_dates, pyarrow
+from periods import MONTH_KEYS
+from streaming import StreamingAggregator
+
+
+STATE_META = 'state.json'
+TABLES_DIR = 'tables'
+
+# Bytes parsed at a time when a delta is large (e.g. the first run)
+BLOCK_SIZE = 64 * 1024 * 1024
+
+# Leading bytes of a source hashed into its watermark, to detect a rewritten file
+FINGERPRINT_SIZE = 64 * 1024
+
+
+def source_files(sources):
+    '''
+    Input: list of CSV exports and/or directories of daily CSV partitions
+    Output: sorted list of CSV file paths
+    '''
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            paths.extend(sorted(glob.glob(os.path.join(glob.escape(source), '*.csv'))))
+        else:
+            paths.append(source)
+    return [os.path.abspath(path) for path in paths]
+
+
+def fingerprint(path, size):
+    '''
+    Input: path to a file and the number of leading bytes to hash
+    Output: hex SHA-256 of those bytes
+    '''
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read(size)).hexdigest()
+
+
+def read_delta(path, watermark=None, block_size=BLOCK_SIZE):
+    '''
+    Input: path to a CSV file and its watermark (None: nothing ingested yet)
+    Output: iterator of (typed dataframe, new watermark); only complete lines are
+            read, a partially written last line is left for the next refresh
+    Example: watermark -> {'offset': 5242880, 'header': [...], 'fingerprint': '9f2c...', 'fingerprint_size': 65536}
+    '''
+    end = os.path.getsize(path)
+    offset, header = (0, None) if watermark is None else (watermark['offset'], watermark['header'])
+    if watermark is not None and (
+            end < offset or
+            watermark['fingerprint'] not in (None, fingerprint(path, watermark['fingerprint_size']))):
+        raise ValueError(f"{path} was rewritten since it was ingested up to byte {offset}: "
+                         f"run the refresh with --rebuild")
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        if header is None:
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                # Empty, or the header is still being written: no watermark, read it next time
+                return
+            header = line.decode().strip().split(',')
+            if sorted(header) != sorted(COLUMNS):
+                raise ValueError(f"{path}: unexpected header {header}")
+            offset = f.tell()
+        while offset < end:
+            block = f.read(min(block_size, end - offset))
+            cut = block.rfind(b'\n') + 1
+            if cut == 0:
+                if offset + len(block) < end:
+                    # A single line longer than the block: read it whole
+                    block += f.readline()
+                    cut = block.rfind(b'\n') + 1
+                if cut == 0:
+                    break
+            f.seek(offset + cut)
+            offset += cut
+            # The header is kept with the offset: later deltas have no header line of their own
+            chunk = pd.read_csv(io.BytesIO(block[:cut]), header=None, names=header, dtype=RAW_SCHEMA)
+            size = min(FINGERPRINT_SIZE, offset)
+            yield narrow_types(parse_dates(chunk)[COLUMNS]), {
+                'offset': offset, 'header': header,
+                'fingerprint': fingerprint(path, size), 'fingerprint_size': size,
+            }
+
+
+class AggregateState(StreamingAggregator):
+    '''
+    StreamingAggregator persisted to a state directory with per-file watermarks
+    '''
+
+    def __init__(self, bands=GAD7_ZONES):
+        super().__init__(bands)
+        self.watermarks = {}
+        self.max_date = None
+        # Incremented by every save, names the arrays file of the state
+        self.version = 0
+
+    @classmethod
+    def load(cls, state_dir, bands=GAD7_ZONES):
+        '''
+        Input: state directory and the zones Bands
+        Output: saved state, or an empty one when the directory has no state yet
+        '''
+        state = cls(bands)
+        meta_path = os.path.join(state_dir, STATE_META)
+        if not os.path.exists(meta_path):
+            return state
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['bands'] != _bands_spec(bands):
+            raise ValueError(f"State in {state_dir} was built with bands {meta['bands']}, "
+                             f"got {_bands_spec(bands)}: run the refresh with --rebuild")
+        arrays = np.load(os.path.join(state_dir, meta['arrays']))
+        state.version = meta['version']
+        state.rows = meta['rows']
+        state.watermarks = {
+            # States saved before the watermarks kept the header and fingerprint: byte offsets only
+            path: watermark if isinstance(watermark, dict) else
+            {'offset': watermark, 'header': COLUMNS, 'fingerprint': None, 'fingerprint_size': 0}
+            for path, watermark in meta['watermarks'].items()
+        }
+        state.max_date = pd.Timestamp(meta['max_date']) if meta['max_date'] else None
+        state.patient_dtype = np.dtype(meta['patient_dtype']) if meta['patient_dtype'] else None
+        state.daily = arrays['daily']
+        state.monthly = arrays['monthly']
+        state.zones = arrays['zones']
+        state.patients = pd.Series(arrays['patient_counts'], index=arrays['patient_ids'])
+        state._month_patients = arrays['month_patients']
+        return state
+
+    def save(self, state_dir):
+        '''
+        Input: state directory
+        Output: None; the arrays go to a new versioned file and only replacing the
+                metadata makes them current, so an interrupted save keeps the old state
+        '''
+        os.makedirs(state_dir, exist_ok=True)
+        self._compact()
+        previous = f"state-{self.version}.npz"
+        self.version += 1
+        arrays = f"state-{self.version}.npz"
+        np.savez(
+            os.path.join(state_dir, arrays), daily=self.daily, monthly=self.monthly, zones=self.zones,
+            patient_ids=self.patients.index.values, patient_counts=self.patients.values,
+            month_patients=self._month_patients,
+            )
+        meta = {
+            'version': self.version,
+            'arrays': arrays,
+            'rows': self.rows,
+            'watermarks': self.watermarks,
+            'max_date': self.max_date.isoformat() if self.max_date is not None else None,
+            'patient_dtype': self.patient_dtype.str if self.patient_dtype is not None else None,
+            'bands': _bands_spec(self.bands),
+        }
+        tmp = os.path.join(state_dir, STATE_META + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp, os.path.join(state_dir, STATE_META))
+        if os.path.exists(os.path.join(state_dir, previous)):
+            os.remove(os.path.join(state_dir, previous))
+
+    def ingest(self, path):
+        '''
+        Input: path to a CSV file
+        Output: (new rows, late rows) folded in since the file's watermark
+        '''
+        new_rows = late_rows = 0
+        latest = self.max_date
+        for chunk, watermark in read_delta(path, self.watermarks.get(path)):
+            if latest is not None:
+                late_rows += int((chunk['date'] < latest).sum())
+            new_rows += len(chunk)
+            self.update(chunk)
+            chunk_max = chunk['date'].max()
+            if self.max_date is None or chunk_max > self.max_date:
+                self.max_date = chunk_max
+            self.watermarks[path] = watermark
+        return new_rows, late_rows
+
+
+def _bands_spec(bands):
+    if bands is None:
+        return None
+    return {'name': bands.name, 'bounds': bands.bounds, 'labels': bands.labels, 'max_score': bands.max_score}
+
+
+def report_tables(report, dimension='zone'):
+    '''
+    Input: Report and the name of its zones dimension
+    Output: dict of the script's tables: assess_count, assess_count_month,
+            patient_month, patient_count and zone_pivot
+    '''
+    tables = {
+        'assess_count': report.daily,
+        'assess_count_month': report.monthly[MONTH_KEYS + ['Assessments Count']],
+        'patient_month': report.monthly[MONTH_KEYS + ['Patients Count']],
+        'patient_count': report.patients,
+    }
+    if report.zones is not None:
+        tables['zone_pivot'] = pivot_zones(report.zones, dimension).reset_index()
+    return tables
+
+
+def write_tables(tables, state_dir):
+    '''
+    Input: dict of tables and the state directory
+    Output: list of written paths (Parquet, or CSV without pyarrow)
+    '''
+    target = os.path.join(state_dir, TABLES_DIR)
+    os.makedirs(target, exist_ok=True)
+    paths = []
+    for name, table in tables.items():
+        if pyarrow is not None:
+            path = os.path.join(target, name + '.parquet')
+            table.to_parquet(path, index=False)
+        else:
+            path = os.path.join(target, name + '.csv')
+            table.to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def remove_state(state_dir):
+    '''
+    Input: state directory
+    Output: list of removed paths; only the state's own files (metadata, arrays and
+            tables) are removed, anything else in the directory is left alone
+    '''
+    removed = []
+    for name in sorted(os.listdir(state_dir)) if os.path.isdir(state_dir) else []:
+        path = os.path.join(state_dir, name)
+        if name in (STATE_META, STATE_META + '.tmp') or re.fullmatch(r'state-\d+\.npz', name):
+            os.remove(path)
+            removed.append(path)
+    tables = os.path.join(state_dir, TABLES_DIR)
+    if os.path.isdir(tables):
+        for name in sorted(os.listdir(tables)):
+            if re.fullmatch(r'\w+\.(parquet|csv)', name):
+                os.remove(os.path.join(tables, name))
+                removed.append(os.path.join(tables, name))
+        if not os.listdir(tables):
+            os.rmdir(tables)
+    return removed
+
+
+def refresh(state_dir, sources, bands=GAD7_ZONES, rebuild=False):
+    '''
+    Input: state directory, CSV exports and/or partition directories, the zones
+           Bands and whether to drop the saved state and start over
+    Output: dict summarizing the refresh
+    '''
+    meta_path = os.path.join(state_dir, STATE_META)
+    version = 0
+    if rebuild:
+        # The rebuilt state keeps counting versions up, so results cached for an
+        # earlier state (result_cache.py) never match it
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                version = json.load(f)['version']
+        remove_state(state_dir)
+    state = AggregateState.load(state_dir, bands)
+    state.version = max(state.version, version)
+    watermarks = dict(state.watermarks)
+    summary = {'files': 0, 'new_rows': 0, 'late_rows': 0}
+    for path in source_files(sources):
+        new_rows, late_rows = state.ingest(path)
+        summary['files'] += bool(new_rows)
+        summary['new_rows'] += new_rows
+        summary['late_rows'] += late_rows
+    # Nothing new: the state, its version and the tables stay as they are
+    if rebuild or state.watermarks != watermarks or not os.path.exists(meta_path):
+        state.save(state_dir)
+        write_tables(report_tables(state.report(), bands.name if bands is not None else None), state_dir)
+    summary['total_rows'] = state.rows
+    summary['watermark'] = state.max_date.isoformat() if state.max_date is not None else None
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('state_dir')
+    parser.add_argument('sources', nargs='+')
+    parser.add_argument('--rebuild', action='store_true', help="drop the saved state and ingest everything")
+    args = parser.parse_args()
+    print(json.dumps(refresh(args.state_dir, args.sources, rebuild=args.rebuild), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""Live aggregates from a stream of assessment events
+
+Events (one assessment each, with the export's columns) are put on an asyncio
+queue, directly with IngestService.submit() or as JSON lines over a local TCP
+socket. A single writer task takes them off the queue in micro-batches (up to
+`batch_size` events or `max_delay` seconds) and folds every batch into a
+StreamingAggregator, so nothing else ever mutates the counts and no lock is needed.
+
+Readers never touch the aggregator: every `snapshot_interval` seconds the writer
+publishes an immutable Snapshot (the Report behind assess_count, patient_count,
+zone_month, ...) by swapping one reference, so a snapshot is at most about
+`snapshot_interval + max_delay` seconds behind the queue.
+
+A malformed event (an unparseable line, a missing field, an id or score that does
+not fit the loader's schema) never stops the writer: it is counted in `rejected`
+and kept in the bounded `quarantine`, and the rest of its batch is folded in.
+
+Usage: python ingest_service.py ROWS [--socket] [--batch-size 10000] [--snapshot-interval 1]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from banding import GAD7_ZONES
+from loader import COLUMNS, DATE_COLUMNS, RAW_SCHEMA, SCHEMA, narrow_types, parse_dates
+from streaming import StreamingAggregator
+
+
+# Published state: rows folded in, time.monotonic() when it was taken and the Report
+Snapshot = namedtuple('Snapshot', ['rows', 'taken_at', 'report'])
+
+# Rejected events kept for inspection (the oldest are dropped first)
+QUARANTINE_SIZE = 1_000
+
+# Put on the queue to make the writer flush, publish a last snapshot and exit
+STOP = None
+
+
+def events_frame(events):
+    '''
+    Input: list of events, as dicts keyed by column or tuples in COLUMNS order
+    Output: typed assessments dataframe; raises ValueError (SchemaError) or
+            TypeError on an event that does not fit the schema
+    '''
+    df = pd.DataFrame.from_records(events, columns=COLUMNS)
+    return narrow_types(parse_dates(df.astype(RAW_SCHEMA)))
+
+
+def split_events(events):
+    '''
+    Input: list of events
+    Output: (typed dataframe of the events that fit the schema, list of the others)
+    '''
+    try:
+        return events_frame(events), []
+    except (ValueError, TypeError):
+        pass
+    # Slow path, only for a batch holding a bad event: coerce every column, keep what fits
+    shaped = np.array([
+        isinstance(event, dict) or (isinstance(event, (tuple, list)) and len(event) == len(COLUMNS))
+        for event in events
+        ], dtype=bool)
+    df = pd.DataFrame.from_records([event for event, ok in zip(events, shaped) if ok], columns=COLUMNS)
+    valid = df['type'].notna().to_numpy(copy=True)
+    for column in DATE_COLUMNS:
+        df[column] = pd.to_datetime(df[column], format='ISO8601', errors='coerce')
+        valid &= df[column].notna().values
+    for column in ['patient_id', 'score']:
+        values = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        limits = np.iinfo(SCHEMA[column])
+        valid &= (values >= limits.min) & (values <= limits.max) & (values == np.floor(values))
+        df[column] = values
+    positions = np.flatnonzero(shaped)
+    rejected = [events[i] for i in sorted(set(range(len(events))) - set(positions[valid].tolist()))]
+    typed = df.loc[valid].reset_index(drop=True)
+    typed['type'] = typed['type'].astype(str).astype('category')
+    return narrow_types(typed), rejected
+
+
+class IngestService:
+    '''
+    Micro-batching single-writer ingestion
+    Input: zones Bands, largest batch, longest wait for a batch to fill (seconds),
+           seconds between snapshots and the queue bound (producers wait when full)
+    Example: service = IngestService()
+             writer = asyncio.create_task(service.run())
+             await service.submit({'date': '2020-07-01T10:00:00', 'patient_id': 1, ...})
+             service.snapshot.report.daily
+    '''
+
+    def __init__(self, bands=GAD7_ZONES, batch_size=10_000, max_delay=0.05, snapshot_interval=1.0,
+                 queue_size=100_000):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.snapshot_interval = snapshot_interval
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.submitted = 0
+        self.batches = 0
+        self.rejected = 0
+        self.quarantine = deque(maxlen=QUARANTINE_SIZE)
+        self._aggregator = StreamingAggregator(bands)
+        self.snapshot = Snapshot(0, time.monotonic(), self._aggregator.report())
+
+    async def submit(self, event):
+        '''
+        Input: one event (dict keyed by column or tuple in COLUMNS order)
+        Output: None, once the event is queued
+        '''
+        await self.queue.put(event)
+        self.submitted += 1
+
+    async def stop(self):
+        await self.queue.put(STOP)
+
+    async def _next_batch(self):
+        '''
+        Output: (list of events, whether STOP was received)
+        '''
+        loop = asyncio.get_running_loop()
+        first = await self.queue.get()
+        if first is STOP:
+            return [], True
+        batch = [first]
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.batch_size:
+            try:
+                event = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if event is STOP:
+                return batch, True
+            batch.append(event)
+        return batch, False
+
+    def _reject(self, events):
+        self.rejected += len(events)
+        self.quarantine.extend(events)
+
+    def _publish(self):
+        self.snapshot = Snapshot(self._aggregator.rows, time.monotonic(), self._aggregator.report())
+
+    async def run(self):
+        '''
+        Writer loop: runs until stop() is called, then publishes a final snapshot
+        Output: the final Snapshot
+        '''
+        stopped = False
+        while not stopped:
+            batch, stopped = await self._next_batch()
+            if batch:
+                try:
+                    frame, rejected = split_events(batch)
+                    if len(frame):
+                        self._aggregator.update(frame)
+                except (ValueError, TypeError):
+                    # Never let one batch end the writer: the queue would fill up behind it
+                    rejected = batch
+                if rejected:
+                    self._reject(rejected)
+                self.batches += 1
+            if stopped or time.monotonic() - self.snapshot.taken_at >= self.snapshot_interval:
+                self._publish()
+        return self.snapshot
+
+    async def _handle(self, reader, writer):
+        try:
+            async for line in reader:
+                if not line.strip():
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # Not JSON: keep the line, not the connection
+                    self._reject([line])
+                    continue
+                await self.submit(event)
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=0):
+        '''
+        Input: address to listen on (port 0: any free port)
+        Output: asyncio server accepting JSON-lines events
+        '''
+        return await asyncio.start_server(self._handle, host, port)
+
+
+async def produce(service, df, rate=None, chunk=1_000):
+    '''
+    Local stand-in producer: submits the rows of an assessments dataframe as events
+    Input: IngestService, dataframe, events per second (None: as fast as possible)
+           and events between two yields to the event loop
+    Output: number of events sent
+    '''
+    start = time.monotonic()
+    sent = 0
+    for event in df[COLUMNS].itertuples(index=False, name=None):
+        await service.submit(event)
+        sent += 1
+        if sent % chunk == 0:
+            delay = sent / rate - (time.monotonic() - start) if rate else 0
+            await asyncio.sleep(max(delay, 0))
+    return sent
+
+
+async def send_lines(host, port, df, chunk=1_000):
+    '''
+    Local stand-in producer over the socket: sends the rows as JSON lines
+    Input: service address, assessments dataframe and rows per write
+    Output: number of events sent
+    '''
+    reader, writer = await asyncio.open_connection(host, port)
+    raw = df[COLUMNS].copy()
+    for column in ['date', 'patient_date_created']:
+        raw[column] = raw[column].dt.strftime('%Y-%m-%dT%H:%M:%S.%f')
+    raw['type'] = raw['type'].astype(str)
+    for start in range(0, len(raw), chunk):
+        lines = raw.iloc[start:start + chunk].to_json(orient='records', lines=True)
+        writer.write(lines.encode() + b'\n')
+        await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+    return len(raw)
+
+
+async def _load_test(df, use_socket, **options):
+    service = IngestService(**options)
+    writer_task = asyncio.create_task(service.run())
+
+    # Reader: how far behind the queue the published snapshot gets
+    staleness = []
+
+    async def monitor():
+        while not writer_task.done():
+            staleness.append(time.monotonic() - service.snapshot.taken_at)
+            await asyncio.sleep(0.05)
+
+    monitor_task = asyncio.create_task(monitor())
+    start = time.perf_counter()
+    if use_socket:
+        server = await service.serve()
+        host, port = server.sockets[0].getsockname()[:2]
+        await send_lines(host, port, df)
+        # The connection handler may still be queueing the last lines
+        while service.submitted + service.rejected < len(df):
+            await asyncio.sleep(0.01)
+        server.close()
+    else:
+        await produce(service, df)
+    await service.stop()
+    snapshot = await writer_task
+    elapsed = time.perf_counter() - start
+    await monitor_task
+    return snapshot, service.batches, elapsed, max(staleness, default=0.0)
+
+
+def main():
+    from aggregates import aggregate
+    from synthetic import generate_assessments
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('rows', type=int)
+    parser.add_argument('--socket', action='store_true', help="send the events as JSON lines over TCP")
+    parser.add_argument('--batch-size', type=int, default=10_000)
+    parser.add_argument('--max-delay', type=float, default=0.05)
+    parser.add_argument('--snapshot-interval', type=float, default=1.0)
+    args = parser.parse_args()
+
+    df = generate_assessments(args.rows)
+    snapshot, batches, elapsed, staleness = asyncio.run(_load_test(
+        df, args.socket, batch_size=args.batch_size, max_delay=args.max_delay,
+        snapshot_interval=args.snapshot_interval,
+        ))
+    print(f"{snapshot.rows:,} events in {batches:,} batches, {elapsed:.2f}s ({snapshot.rows / elapsed:,.0f} events/s)")
+    print(f"oldest snapshot seen by the reader: {staleness:.2f}s")
+    expected = aggregate(df.copy())
+    same = all(
+        getattr(snapshot.report, table).reset_index(drop=True).equals(getattr(expected, table).reset_index(drop=True))
+        for table in ['daily', 'monthly', 'patients']
+        )
+    print(f"final snapshot matches aggregate(): {same}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""Typed loader for the GAD-7 assessments export (phq_all_final.csv)
+
+The raw file is read once with an explicit schema so pandas never has to infer
+types, and the typed frame is cached next to the source as Parquet (or Arrow/
+Feather). The cache name carries the source file's mtime and size, so editing or
+replacing the CSV automatically invalidates it.
+
+Timestamps such as 2019-08-26T13:32:43.019162 are parsed once, column-wise, by
+Arrow's ISO-8601 cast (pandas' ISO-8601 parser without pyarrow). pyarrow is
+optional: without it there is no cache and parsing is slower.
+
+The integer columns are read wide and nullable (RAW_SCHEMA) and only narrowed to
+SCHEMA once every value is known to fit: a missing or out-of-range value raises
+SchemaError instead of being wrapped (a score of 261 is never read as 5). Exports
+that fail can be checked and cleaned with validation.py.
+"""
+
+import glob
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.compute
+except ImportError:
+    pyarrow = None
+
+
+# Column order of the raw export
+COLUMNS = ['date', 'patient_id', 'type', 'patient_date_created', 'score']
+
+# Explicit dtypes of the non-date columns
+SCHEMA = {
+    'patient_id': 'int32',
+    'score': 'uint8',
+    'type': 'category',
+}
+
+# Dtypes the raw columns are read with: float64 holds missing values (NaN) and every
+# integer id or score exactly, so nothing is wrapped or rejected before narrow_types checks it
+RAW_SCHEMA = {
+    'patient_id': 'float64',
+    'score': 'float64',
+    'type': 'category',
+}
+
+# Columns that are parsed into datetime64[ns]
+DATE_COLUMNS = ['date', 'patient_date_created']
+
+# Rows per Parquet row group of the cache: small enough for readers to skip the
+# row groups a date or patient filter excludes (see query.py)
+ROW_GROUP_SIZE = 131_072
+
+# Layout version of the cache, part of its name: bumping it rebuilds the caches
+# written by earlier versions (2: ROW_GROUP_SIZE row groups)
+CACHE_VERSION = 2
+
+CACHE_FORMATS = {
+    'parquet': '.parquet',
+    'feather': '.arrow',
+}
+
+
+class SchemaError(ValueError):
+    '''
+    Raised when values of the export do not fit SCHEMA (missing or out of range)
+    '''
+
+
+def narrow_array(values, dtype, name):
+    '''
+    Input: numeric array or series, integer dtype and the column name used in the error
+    Output: array cast to dtype; raises SchemaError when a value is missing,
+            fractional or does not fit the dtype
+    Example: narrow_array([300], 'uint8', 'score') -> SchemaError, not [44]
+    '''
+    if isinstance(values, (pd.Series, pd.Index)):
+        values = values.to_numpy(dtype=np.float64, na_value=np.nan) if values.hasnans else values.to_numpy()
+    values = np.asarray(values)
+    if values.dtype == dtype:
+        return values
+    limits = np.iinfo(dtype)
+    if values.dtype.kind in 'iu':
+        valid = (values >= limits.min) & (values <= limits.max)
+    else:
+        values = values.astype(np.float64, copy=False)
+        # NaN fails every comparison: missing values count as invalid
+        valid = (values >= limits.min) & (values <= limits.max) & (values == np.floor(values))
+    invalid = len(values) - int(np.count_nonzero(valid))
+    if invalid:
+        raise SchemaError(f"{name}: {invalid} values missing, fractional or outside the {np.dtype(dtype)} range "
+                          f"[{limits.min}, {limits.max}], check the export with validation.py")
+    return values.astype(dtype)
+
+
+def narrow_types(df):
+    '''
+    Input: dataframe read with RAW_SCHEMA
+    Output: the same dataframe with the integer columns cast to SCHEMA; raises
+            SchemaError when a value is missing or does not fit the narrow dtype
+    Example: score 261 -> SchemaError, not 5
+    '''
+    for column, dtype in SCHEMA.items():
+        if dtype == 'category' or df[column].dtype == dtype:
+            continue
+        df[column] = narrow_array(df[column].values, dtype, column)
+    return df
+
+
+def parse_timestamps(values):
+    '''
+    Input: series or array of ISO-8601 timestamp strings
+    Output: datetime64 series (microsecond precision is kept)
+    Example: 2019-08-26T13:32:43.019162 -> Timestamp('2019-08-26 13:32:43.019162')
+    '''
+    index = values.index if isinstance(values, pd.Series) else None
+    if pyarrow is not None:
+        try:
+            parsed = pyarrow.compute.cast(
+                pyarrow.array(values, type=pyarrow.string(), from_pandas=True), pyarrow.timestamp('us')
+                )
+            return pd.Series(parsed.to_numpy(zero_copy_only=False), index=index)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            # Not plain ISO-8601 (e.g. a UTC offset): let pandas handle it
+            pass
+    return pd.Series(pd.to_datetime(values, format='ISO8601'), index=index)
+
+
+def parse_dates(df, columns=DATE_COLUMNS):
+    '''
+    Input: dataframe with raw ISO timestamp strings
+    Output: the same dataframe with the columns converted to datetime64
+    '''
+    for column in columns:
+        if not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = parse_timestamps(df[column])
+    return df
+
+
+def add_time_columns(df, column='date'):
+    '''
+    Input: dataframe with a datetime64 column
+    Output: the same dataframe with the column truncated to the second and a
+            '<column>_hms' column holding the day
+    Example: 2019-08-26 13:32:43.019162 -> 2019-08-26 13:32:43 ('date') and 2019-08-26 ('date_hms')
+    '''
+    df[column + '_hms'] = df[column].dt.normalize()
+    df[column] = df[column].dt.floor('s')
+    return df
+
+
+def read_assessments_csv(path, narrow=True):
+    '''
+    Input: path to the raw CSV export and whether to narrow the integer columns
+    Output: dataframe typed according to SCHEMA (RAW_SCHEMA when narrow is False)
+            and DATE_COLUMNS
+    '''
+    df = pd.read_csv(path, usecols=COLUMNS, dtype=RAW_SCHEMA)
+    df = parse_dates(df)[COLUMNS]
+    return narrow_types(df) if narrow else df
+
+
+def iter_assessments_csv(path, chunksize=1_000_000):
+    '''
+    Input: path to a raw CSV export and the number of rows per chunk
+    Output: iterator of typed dataframes of at most chunksize rows
+    '''
+    with pd.read_csv(path, usecols=COLUMNS, dtype=RAW_SCHEMA, chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield narrow_types(parse_dates(chunk)[COLUMNS])
+
+
+def cache_path(path, cache_dir=None, fmt='parquet', tag=None):
+    '''
+    Input: path to the raw CSV export, cache directory, cache format and an optional
+           tag naming another frame cached for the same source (e.g. 'unchecked')
+    Output: path of the cache file for the current version of the source
+    Example: phq_all_final.csv -> phq_all_final.csv.v2.1595980800000000000-5242880.parquet
+    '''
+    if fmt not in CACHE_FORMATS:
+        raise ValueError(f"Unknown cache format: {fmt!r}, expected one of {sorted(CACHE_FORMATS)}")
+    stat = os.stat(path)
+    cache_dir = cache_dir or os.path.dirname(os.path.abspath(path))
+    tag = f".{tag}" if tag else ''
+    name = f"{os.path.basename(path)}.v{CACHE_VERSION}.{stat.st_mtime_ns}-{stat.st_size}{tag}{CACHE_FORMATS[fmt]}"
+    return os.path.join(cache_dir, name)
+
+
+def _remove_stale_caches(path, current, cache_dir=None):
+    cache_dir = cache_dir or os.path.dirname(os.path.abspath(path))
+    # Only this source's caches, of any layout or tag: 'a.csv.bak.<mtime>-<size>.parquet' belongs to another file
+    extensions = '|'.join(re.escape(extension) for extension in CACHE_FORMATS.values())
+    own = re.compile(
+        re.escape(os.path.basename(path)) + rf'(?:\.v\d+)?\.\d+-\d+(?:\.[a-z]+)?(?:{extensions})(?:\.tmp)?'
+        )
+    pattern = os.path.join(glob.escape(cache_dir), glob.escape(os.path.basename(path)) + '.*')
+    for stale in glob.glob(pattern):
+        if stale != current and own.fullmatch(os.path.basename(stale)):
+            os.remove(stale)
+
+
+def load_assessments(path, cache=True, cache_dir=None, fmt='parquet'):
+    '''
+    Input: path to the raw CSV export, whether to use the columnar cache,
+           the cache directory (defaults to the source's directory) and the
+           cache format ('parquet' or 'feather')
+    Output: typed assessments dataframe
+    '''
+    if not cache or pyarrow is None:
+        return read_assessments_csv(path)
+
+    target = cache_path(path, cache_dir, fmt)
+    if os.path.exists(target):
+        if fmt == 'parquet':
+            return pd.read_parquet(target)
+        return pd.read_feather(target)
+
+    df = read_assessments_csv(path)
+    write_cache(df, path, target, cache_dir, fmt)
+    return df
+
+
+def write_cache(df, path, target, cache_dir=None, fmt='parquet'):
+    '''
+    Input: frame read from the source at path, its cache file (see cache_path),
+           the cache directory and format
+    Output: None; the source's other caches (older versions or layouts) are removed
+    '''
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    _remove_stale_caches(path, target, cache_dir)
+    # Write to a temporary file first so a crashed run never leaves a half-written cache
+    tmp = target + '.tmp'
+    if fmt == 'parquet':
+        df.to_parquet(tmp, index=False, row_group_size=ROW_GROUP_SIZE)
+    else:
+        df.to_feather(tmp)
+    os.replace(tmp, target)
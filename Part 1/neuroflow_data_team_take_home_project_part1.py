@@ -15,8 +15,13 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 
-# Import dataset
-df = pd.read_csv("/content/sample_data/phq_all_final.csv")
+from validation import format_summary, read_checked, validate
+
+DATA_PATH = "/content/sample_data/phq_all_final.csv"
+
+# Import dataset with explicit dtypes, cached as Parquet for the next runs. Values that do not fit the dtypes (e.g. a 
+# missing or out-of-range score) are kept as written for the checks of the next section instead of failing the load
+df = read_checked(DATA_PATH)
 # Review the dataset
 df.head()
 # First column: the time the measurement was made
@@ -35,43 +40,42 @@ Descriptive statistics and some quick visualizations will be included. Further i
 df.info()
 
 """The first thing that I notice is how clean the data is! All of the data are non-null values which is a good start. 
-I will try to eliminate the duplicates in the next step."""
-
-# Drop duplicates
-df.drop_duplicates()
+Next, I will check the quality of the records in one pass: duplicated rows, scores outside 0-21, records that are not 
+from GAD-7 assessments, assessments dated before the patient was created and null values. The records failing a check 
+are set aside in a quarantine table, with the checks they failed, and the analysis goes on with the clean records. 
+(`python validation.py DATA_PATH --quarantine quarantine.csv` runs the same checks from the command line.)"""
 
-"""No duplicates at all which is perfect. The next step will be checking if any of the records are not from GAD-7 
-assessments."""
+# Drop the records failing a check, keep them aside in 'quarantine'
+df, quarantine, quality = validate(df)
+print(format_summary(quality))
+quarantine.head()
 
-for n, test_type in enumerate(df['type'].tolist()):
-    if test_type != 'gad7'.lower(): 
-        print(df[n])
-
-"""Seems like all of the records are from GAD-7 assessments. The next step will include some quick visualizations on 
-the data based on various "grouped by" approaches.
+"""The next step will include some quick visualizations on the data based on various "grouped by" approaches.
 
 ### **Grouped by 'date'**
 I want to see how many assessments have been taken throughout the timeline given by the dataset.
 """
 
-# Convert to datetime
-df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d').dt.date
+from aggregates import aggregate
+from banding import GAD7_SEVERITY, GAD7_ZONES, add_bands
+
+# Add the 'zone' and 'severity' columns derived from the score (see the "Grouped by 'score'" section)
+add_bands(df, [GAD7_ZONES, GAD7_SEVERITY])
+# Compute every metric of the report in one pass over the data: daily and monthly assessments counts,
+# monthly patients counts, assessments per patient and monthly zones counts
+report = aggregate(df, dimension='zone')
 
 # Count the assesssments by date
-assess_count = df.groupby(['date']).size().reset_index(name="Assessments Count")
+assess_count = report.daily
 # Check the new dataframe
 assess_count.head()
 
 """Looking good. Next, I will separate the dataframe into two smaller ones with one containing assessments counts of 
 2019 and the other one containing those of 2020. """
 
-# Create a list of rows in 2019
-data_2019 = [date for date in assess_count['date'].values if date.year==2019]
-# Create a list of rows in 2020
-data_2020 = [date for date in assess_count['date'].values if date.year==2020]
 # Slice the dataframe into two
-assess_count_2019 = assess_count[assess_count['date'].isin(data_2019)]
-assess_count_2020 = assess_count[assess_count['date'].isin(data_2020)]
+assess_count_2019 = assess_count[assess_count['date'].dt.year==2019]
+assess_count_2020 = assess_count[assess_count['date'].dt.year==2020]
 # Check the new dataframes' information
 print(assess_count_2019.info())
 print(assess_count_2020.info())
@@ -84,7 +88,7 @@ ax = assess_count_2019.plot.bar(
     x="date", y="Assessments Count", color="#A1CCC3",
     figsize=(15,7), label="Assessments Count"
     ) 
-ax.set_xticklabels(assess_count_2019["date"], rotation=90, size=5)
+ax.set_xticklabels(assess_count_2019["date"].dt.date, rotation=90, size=5)
 # Setting labels 
 ax.set_title("Assessment Counts in 2019", size=14)
 ax.set_xlabel("Date", size=12)
@@ -99,7 +103,7 @@ ax = assess_count_2020.plot.bar(
     x="date", y="Assessments Count", color='#72B3A5',
     figsize=(15,7), label="Assessments Count"
     )
-ax.set_xticklabels(assess_count_2020["date"], rotation=90, size=5)
+ax.set_xticklabels(assess_count_2020["date"].dt.date, rotation=90, size=5)
 # Setting labels 
 ax.set_title("Assessment Counts in 2020", size=14)
 ax.set_xlabel("Date", size=12)
@@ -126,30 +130,13 @@ Before moving on to another "grouped by" section, I still want to do one little
 of monthly assessment counts from June 2019 to July 2020.
 """
 
-import calendar
-
-# Create a copy of the original dataframe
-temp_df = df.copy()
-# Extract year and month
-temp_df['year'] = pd.DatetimeIndex(temp_df['date']).year
-temp_df['month'] = pd.DatetimeIndex(temp_df['date']).month
-# Convert to month name
-temp_df['month name'] = temp_df['month'].apply(lambda x: calendar.month_abbr[x])
-# Create a new "Month Year" column
-temp_df['Month Year'] = temp_df['month name'] + ' ' + temp_df['year'].astype('str')
-# Create a new dataframe containing assessment counts per month, year. 
-assess_count_month = temp_df.groupby(
-    ['Month Year', 'month', 'year']).size().reset_index(name="Assessments Count"
-    )
-# Sort values by year then month
-assess_count_month = assess_count_month.sort_values(['year', 'month'])
+from periods import MONTH_KEYS
 
-assess_count_month = assess_count_month.reset_index(drop=True)
+# Assessment counts per month, year, already sorted by year then month
+assess_count_month = report.monthly[MONTH_KEYS + ['Assessments Count']]
 # Check the new dataframe
 assess_count_month
 
-del temp_df
-
 # Plotting
 fig = plt.figure()
 ax = assess_count_month.plot(
@@ -181,10 +168,8 @@ print(f"The number of unique patients: {len(np.unique(df['patient_id']))}")
 """Let's check the frequency of these unique patients appearing in the dataset. In other words, let's see how many times 
 each patient took the assessment."""
 
-patient_count = df.groupby(['patient_id']).size().reset_index(name="times_taken")
-# Sort the values in descending order
-patient_count.sort_values(by=['times_taken'], ascending=False, inplace=True)
-patient_count.reset_index(drop=True, inplace=True)
+# Assessments per patient, already sorted in descending order
+patient_count = report.patients
 patient_count.head(20)
 
 print("Percentage of patients taking the test only once:")
@@ -205,37 +190,11 @@ Before moving on to the next section, I want to discover the monthly total numbe
 effort to test one of the hypotheses mentioned in the ***Grouped by 'date'*** part where I suggest that the increased number 
 of patients taking the test in 2020 is among the factors creating the rise of assessments count in 2020 compared to 2019.
 
-First, let's create a dataframe containing a month-year column and another column listed out all the individual patients 
-taking the tests in each month.
-"""
+The aggregation engine counts the individual patients taking the tests in each month directly, without building a table 
+of every patient in every month first. Let's separate this dataframe into a 2019 table and a 2020 table."""
 
-# Create a copy of the original dataframe
-temp_df = df.copy()
-# Extract year and month
-temp_df['year'] = pd.DatetimeIndex(temp_df['date']).year
-temp_df['month'] = pd.DatetimeIndex(temp_df['date']).month
-# Convert to month name
-temp_df['month name'] = temp_df['month'].apply(lambda x: calendar.month_abbr[x])
-# Create a new "Month Year" column
-temp_df['Month Year'] = temp_df['month name'] + ' ' + temp_df['year'].astype('str')
-# Create a new dataframe containing patient counts per month, year. 
-patient_month = temp_df.groupby(
-    ['Month Year', 'month', 'year', 'patient_id']).size().reset_index(name='Patients Count'
-    )
-# Sort values by year then month
-patient_month = patient_month.sort_values(['year', 'month'])
-
-patient_month.reset_index(drop=True, inplace=True)
-# Check the dataframe
-patient_month
-
-del temp_df
-
-"""Let's separate this dataframe into a 2019 table and a 2020 table. Also, I will count the total number of individual 
-patients in each month."""
-
-patient_month = patient_month.groupby(['Month Year', 'month', 'year']).size().reset_index(name='Patients Count')
-patient_month.sort_values(['year', 'month'], inplace=True)
+# Patients counts per month, year, already sorted by year then month
+patient_month = report.monthly[MONTH_KEYS + ['Patients Count']]
 # 2019
 patient_count_2019 = patient_month[patient_month['year']==2019]
 # 2020
@@ -315,54 +274,20 @@ falling into the two pre-defined zones. This approach, in a way, neglects the in
 that is the ultimate purpose - to simplify the analysis. In other words, let's assume that no one took the assessment more than 
 once in a single month.
 
-First, let's do a little data preprocessing by replacing the raw scores with categorical values. There are two ways of doing this. 
-I will map the raw scores to 'safe_zone' and 'red_zone', and I will map the raw scores to the severity labels: 'low_to_minimal', 
-'mild', 'moderate', and 'severe'. These two ways will serve two different purposes.
+First, let's do a little data preprocessing by banding the raw scores into categorical values. There are two ways of doing this. 
+I map the raw scores to 'safe_zone' and 'red_zone' (the 'zone' column, a score of 10 or above is in the 'red zone'), and I map the 
+raw scores to the severity labels: 'low_to_minimal' (0-5), 'mild' (6-10), 'moderate' (11-15), and 'severe' (16-21) (the 'severity' 
+column). These two ways will serve two different purposes. Both columns were added next to 'score' before computing the report.
 """
 
-# 'safe_zone' and 'red_zone' mapping
-df_two = df.copy()
-df_two['score'] = df_two['score'].map({
-    0:'safe_zone', 1:'safe_zone', 2:'safe_zone', 3:'safe_zone',
-    4:'safe_zone', 5:'safe_zone', 6:'safe_zone', 7:'safe_zone',
-    8:'safe_zone', 9:'safe_zone', 10:'red_zone', 11:'red_zone',
-    12:'red_zone', 13:'red_zone', 14:'red_zone', 15:'red_zone',
-    16:'red_zone', 17:'red_zone', 18:'red_zone', 19:'red_zone',
-    20:'red_zone', 21:'red_zone'
-})
-# Check the new dataframe
-df_two
-
-# Severity labels
-df_four = df.copy()
-df_four['score'] = df_four['score'].map({
-    0:'low_to_minimal', 1:'low_to_minimal', 2:'low_to_minimal', 3:'low_to_minimal',
-    4:'low_to_minimal', 5:'low_to_minimal', 6:'mild', 7:'mild',
-    8:'mild', 9:'mild', 10:'mild', 11:'moderate',
-    12:'moderate', 13:'moderate', 14:'moderate', 15:'moderate',
-    16:'severe', 17:'severe', 18:'severe', 19:'severe',
-    20:'severe', 21:'severe'
-})
-# Check the new dataframe
-df_four
+# Check the banded columns
+df[['score', 'zone', 'severity']]
 
-"""Let's deal with *df_two* first. With this dataframe, I will redo the groupby process that I have done earlier with *'patient 
+"""Let's deal with the zones first. With this column, I will redo the groupby process that I have done earlier with *'patient 
 id'* to get the monthly counts of records in each of the zone."""
 
-# Extract year and month
-df_two['year'] = pd.DatetimeIndex(df_two['date']).year
-df_two['month'] = pd.DatetimeIndex(df_two['date']).month
-# Convert to month name
-df_two['month name'] = df_two['month'].apply(lambda x: calendar.month_abbr[x])
-# Create a new "Month Year" column
-df_two['Month Year'] = df_two['month name'] + ' ' + df_two['year'].astype('str')
-# Create a new dataframe containing zones counts per month, year. 
-zone_month = df_two.groupby(
-    ['Month Year', 'month', 'year', 'score']).size().reset_index(name='Zones Count')
-# Sort values by year then month
-zone_month = zone_month.sort_values(['year', 'month'])
-
-zone_month.reset_index(drop=True, inplace=True)
+# Zones counts per month, year, already sorted by year then month
+zone_month = report.zones[MONTH_KEYS + ['zone', 'Zones Count']]
 # Check the dataframe
 zone_month
 
@@ -370,12 +295,12 @@ zone_month
 
 # 2019
 zones_count_2019 = zone_month[zone_month['year']==2019]
-safe_count_2019 = zones_count_2019[zones_count_2019['score']=='safe_zone']
-red_count_2019 = zones_count_2019[zones_count_2019['score']=='red_zone']
+safe_count_2019 = zones_count_2019[zones_count_2019['zone']=='safe_zone']
+red_count_2019 = zones_count_2019[zones_count_2019['zone']=='red_zone']
 # 2020
 zones_count_2020 = zone_month[zone_month['year']==2020]
-safe_count_2020 = zones_count_2020[zones_count_2020['score']=='safe_zone']
-red_count_2020 = zones_count_2020[zones_count_2020['score']=='red_zone']
+safe_count_2020 = zones_count_2020[zones_count_2020['zone']=='safe_zone']
+red_count_2020 = zones_count_2020[zones_count_2020['zone']=='red_zone']
 
 """Now, comes the visualization part."""
 
@@ -426,17 +351,11 @@ plt.show()
 """I will provide a stacked bar graph to display the percentage of the proportion of 'safe_zone' and 'red_zone' more efficiently. Before 
 plotting, I need to make a few transformation to the *zone_month* dataframe."""
 
-# Make 'safe_zone' and 'red_zone' two columns instead of categorical values
-zone_pivot = zone_month.pivot(
-    index=['year', 'month']
-    , columns='score', values='Zones Count'
-    )
-zone_pivot.sort_index(inplace=True)
-# Add the 'Month Year' column to the new pivoted dataframe
-zone_pivot.insert(
-    0, 'Month Year', 
-    safe_count_2019['Month Year'].values.tolist() + safe_count_2020['Month Year'].values.tolist()
-    )
+from aggregates import pivot_zones
+
+# Make 'safe_zone' and 'red_zone' two columns instead of categorical values, indexed by year, month,
+# with the 'Month Year' column added
+zone_pivot = pivot_zones(zone_month)
 # Check the dataframe
 zone_pivot
 
@@ -482,104 +401,38 @@ monitor their own mental health status.
 The top 3 patients ID are: 10687, 6574, 12307. Firstly, I will extract the records of these three patients from the original dataframe.
 """
 
-# Function that reformat the 'date' column
-def convert_date(x):
-    '''
-    Input: raw datetime object
-    Output: reformatted datetime object
-    Example: 2019-08-26T13:32:43.019162	-> 2019-08-26 13:32:43
-    '''
-    x = x.replace('T', ' ')[:19]
-    return x
-
-def convert_date_hms(x):
-    '''
-    Input: raw datetime object
-    Output: reformatted datetime object
-    Example: 2019-08-26T13:32:43.019162	-> 2019-08-26
-    '''
-    x = x.replace('T', ' ')[:10]
-    return x
-
-# Reimport the dataset to reconvert the datetime
-df = pd.read_csv("/content/sample_data/phq_all_final.csv")
-df['date'] = df['date'].apply(convert_date)
-df['date_hms'] = df['date'].apply(convert_date_hms)
+from patient_index import PatientIndex
+
+# Index the records by patient once: every patient's history becomes a slice sorted by date
+patients = PatientIndex(df)
 
 # Extract the patients data
-patient_10687 = df[df['patient_id']==10687]
-patient_6574 = df[df['patient_id']==6574]
-patient_12307 = df[df['patient_id']==12307]
+patient_10687, patient_6574, patient_12307 = [
+    patients.get(patient_id).reset_index(drop=True) for patient_id in [10687, 6574, 12307]
+    ]
+
+from loader import add_time_columns
 
-# Reset index
-patient_10687.reset_index(drop=True, inplace=True)
-patient_6574.reset_index(drop=True, inplace=True)
-patient_12307.reset_index(drop=True, inplace=True)
+# Reformat the 'date' column of the extracted records, keeping real timestamps for the charts
+# Example: 2019-08-26 13:32:43.019162 -> 2019-08-26 13:32:43 ('date') and 2019-08-26 ('date_hms')
+for patient in [patient_10687, patient_6574, patient_12307]:
+    add_time_columns(patient)
 
 # Check one dataframe
 patient_10687
 
 """The 'date' column looks good. Now I will visualize the assessment scores on a timeline for the three patients."""
 
-# Plotting patient 10687
-fig = plt.figure()
-
-# Calculate the simple average of the data
-y_mean = [np.mean(patient_10687['score'])]*len(patient_10687)
+from charts import plot_scores
 
-ax = patient_10687.plot(
-    x='date', y='score', color='#A1CCC3', figsize=(20,8), label='Score'
-    )
-mean_line = ax.plot(patient_10687['date'], y_mean, label='Mean', 
-                    linestyle='--', color='#05261e')
-ax.set_xticks([i for i in range(patient_10687.shape[0])])
-ax.set_xticklabels(patient_10687["date"], rotation=90, size=8)
-ax.set_title("Scores of Patient 10687 from June 2019 to July 2020")
-ax.set_xlabel("Date", size=12)
-ax.set_ylabel("Score", size=12)
-ax.legend(loc='upper right')
-ax.autoscale(tight=False)
-plt.show()
+# Plotting the three patients on a datetime axis with their mean score
+for patient_id, patient in zip([10687, 6574, 12307], [patient_10687, patient_6574, patient_12307]):
+    fig, ax = plt.subplots(1,1, figsize=(15,8))
+    plot_scores(ax, patient['date'], patient['score'], patient_id)
+    plt.show()
 
-# Plotting patient 6574
-fig = plt.figure()
-
-# Calculate the simple average of the data
-y_mean = [np.mean(patient_6574['score'])]*len(patient_6574)
-
-ax = patient_6574.plot(
-    x='date', y='score', color='#A1CCC3', figsize=(15,8), label='Score'
-    )
-mean_line = ax.plot(patient_6574['date'], y_mean, label='Mean', 
-                    linestyle='--', color='#05261e')
-ax.set_xticks([i for i in range(patient_6574.shape[0])])
-ax.set_xticklabels(patient_6574["date"], rotation=90, size=8)
-ax.set_title("Scores of Patient 6574 from June 2019 to July 2020")
-ax.set_xlabel("Date", size=12)
-ax.set_ylabel("Score", size=12)
-ax.legend(loc='upper right')
-ax.autoscale(tight=False)
-plt.show()
-
-# Plotting patient 12307
-fig = plt.figure()
-
-# Calculate the simple average of the data
-y_mean = [np.mean(patient_12307['score'])]*len(patient_12307)
-
-ax = patient_12307.plot(
-    x='date', y='score', color='#A1CCC3', figsize=(15,8), label='Score'
-    )
-mean_line = ax.plot(patient_12307['date'], y_mean, label='Mean', 
-                    linestyle='--', color='#05261e')
-ax.set_xticks([i for i in range(patient_12307.shape[0])])
-ax.set_xticklabels(patient_12307["date"], rotation=90, size=8)
-ax.set_title("Scores of Patient 12307 from June 2019 to July 2020")
-ax.set_xlabel("Date", size=12)
-ax.set_ylabel("Score", size=12)
-ax.legend(loc='upper right')
-ax.autoscale(tight=False)
-plt.show()
+"""The same charts can be rendered for any number of patients in parallel, e.g. the top 100 test takers:
+`render_patient_charts(patients, 'charts/', top=100)` or `python charts.py phq_all_final.csv charts/ --top 100`."""
 
 """According to the charts, all of the three patients started taking their first assessment in 2019. Patient 10687 took his/her 
 first test on June 18, 2010. Patient 6574 took his/her first test on June 12, 2019. Patient 12307 started on September 26, 2019, 
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""Multi-core aggregation of the report tables
+
+The assessments are hash-partitioned by patient_id (splitmix64 hash, see hll.py)
+and the date, patient_id and score columns are copied once, partition after
+partition, into shared memory blocks. Each worker process attaches to the blocks
+and aggregates its own row range with a StreamingAggregator: no rows are pickled,
+only the partial counts come back. Because a patient's rows all land in the same
+partition, the per-patient counts and the distinct (month, patient) pairs of the
+partitions never overlap, and the merged Report is exactly the one
+aggregates.aggregate() computes on one core.
+
+Usage: python parallel.py [--rows 10000000] [--workers 1 2 4 8]
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from banding import GAD7_ZONES
+from hll import hash64
+from loader import narrow_array
+from streaming import StreamingAggregator
+
+
+# Columns shared with the workers, stored as plain numeric arrays
+SHARED_COLUMNS = {
+    'date': np.int64,
+    'patient_id': np.int32,
+    'score': np.uint8,
+}
+
+
+def partition(patient_ids, partitions):
+    '''
+    Input: array of patient ids and the number of partitions
+    Output: (row order grouping the partitions, offsets of each partition in that order)
+    '''
+    parts = (hash64(patient_ids) % np.uint64(partitions)).astype(np.uint16)
+    # Stable sort of small integers is a radix sort: O(rows)
+    order = np.argsort(parts, kind='stable')
+    offsets = np.r_[0, np.cumsum(np.bincount(parts, minlength=partitions))]
+    return order, offsets
+
+
+def _aggregate_partition(task):
+    '''
+    Input: (dict of column -> (shared memory name, dtype), rows in the blocks,
+            first row, end row, zones Bands)
+    Output: StreamingAggregator of the row range
+    '''
+    columns, rows, start, stop, bands = task
+    # The pool's processes share the parent's resource tracker: the parent unlinks the blocks
+    blocks = {column: shared_memory.SharedMemory(name=name) for column, (name, dtype) in columns.items()}
+    try:
+        arrays = {
+            column: np.ndarray(rows, dtype=columns[column][1], buffer=block.buf)[start:stop]
+            for column, block in blocks.items()
+            }
+        chunk = pd.DataFrame({
+            'date': arrays['date'].view('datetime64[ns]'),
+            'patient_id': arrays['patient_id'],
+            'score': arrays['score'],
+            }, copy=False)
+        aggregator = StreamingAggregator(bands).update(chunk)
+        aggregator._compact()
+        del arrays, chunk
+        return aggregator
+    finally:
+        for block in blocks.values():
+            block.close()
+
+
+def aggregate_parallel(df, bands=GAD7_ZONES, workers=None, partitions=None):
+    '''
+    Input: assessments dataframe ('date', 'patient_id', 'score'), zones Bands,
+           number of worker processes (None: one per CPU) and of hash partitions
+           (default: one per worker)
+    Output: Report, identical to aggregates.aggregate(df, dimension=bands.name)
+            with the bands applied
+    '''
+    workers = workers or os.cpu_count() or 1
+    partitions = partitions or workers
+    order, offsets = partition(df['patient_id'].values, partitions)
+
+    blocks, columns = [], {}
+    try:
+        for column, dtype in SHARED_COLUMNS.items():
+            values = df[column].values
+            if column == 'date':
+                values = np.asarray(values, dtype='datetime64[ns]').view(np.int64)
+            # Checked, not wrapped: an id outside int32 or a score over 255 raises SchemaError
+            values = narrow_array(values, dtype, column)
+            block = shared_memory.SharedMemory(create=True, size=max(len(df) * np.dtype(dtype).itemsize, 1))
+            blocks.append(block)
+            np.take(values, order, out=np.ndarray(len(df), dtype=dtype, buffer=block.buf))
+            columns[column] = (block.name, dtype)
+
+        tasks = [
+            (columns, len(df), int(offsets[i]), int(offsets[i + 1]), bands)
+            for i in range(partitions) if offsets[i + 1] > offsets[i]
+            ]
+        merged = StreamingAggregator(bands)
+        if workers == 1:
+            # No pool: the partitions are aggregated in this process
+            for partial in map(_aggregate_partition, tasks):
+                merged.merge(partial)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for partial in pool.map(_aggregate_partition, tasks):
+                    merged.merge(partial)
+        return merged.report()
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def same_report(left, right):
+    '''
+    Input: two Reports
+    Output: True when all their tables are equal
+    '''
+    tables = ['daily', 'monthly', 'patients', 'zones']
+    return all(
+        getattr(left, table).reset_index(drop=True).equals(getattr(right, table).reset_index(drop=True))
+        for table in tables
+        )
+
+
+def main():
+    from aggregates import aggregate
+    from banding import add_bands
+    from synthetic import generate_assessments
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    df = generate_assessments(args.rows)
+    start = time.perf_counter()
+    expected = aggregate(add_bands(df.copy(), [GAD7_ZONES]), dimension='zone')
+    single = time.perf_counter() - start
+    print(f"{args.rows:,} rows, {os.cpu_count()} CPUs")
+    print(f"  aggregate()        {single:8.3f}s")
+    for workers in args.workers:
+        start = time.perf_counter()
+        report = aggregate_parallel(df, workers=workers)
+        elapsed = time.perf_counter() - start
+        # Against the single-core aggregate(), whatever worker counts were asked for
+        speedup = single / elapsed
+        print(f"  {workers:>3} workers        {elapsed:8.3f}s  speedup {speedup:5.2f}x  "
+              f"efficiency {speedup / workers:4.0%}  exact: {same_report(report, expected)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Date-partitioned Parquet layout of the assessments
+
+The assessments are written as Hive-style partitions, one directory per calendar
+month:
+
+    ROOT/year=2019/month=6/part-0-0.parquet
+    ROOT/year=2019/month=7/part-0-0.parquet
+    ...
+
+so a question about a date range only opens the files of the months it overlaps.
+query.Query reads such a directory: it prunes the partitions from the directory
+names first, then pushes the remaining filters down to the row groups of the files
+it kept. Writing replaces the partitions covered by the new data and leaves the
+other months alone, so a month can be rewritten (or a new one added) without
+touching the history.
+
+Usage: python partitions.py SOURCE ROOT
+"""
+
+import argparse
+import glob
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from loader import COLUMNS, ROW_GROUP_SIZE, pyarrow
+
+if pyarrow is not None:
+    import pyarrow.dataset
+
+
+PARTITION_PATTERN = re.compile(r'year=(\d+)[/\\]month=(\d+)$')
+
+
+def partition_dir(root, year, month):
+    return os.path.join(root, f"year={year}", f"month={month}")
+
+
+def partitions(root):
+    '''
+    Input: root of a partitioned layout
+    Output: sorted list of (year, month, directory) of the existing partitions
+    '''
+    found = []
+    for path in glob.glob(os.path.join(glob.escape(root), 'year=*', 'month=*')):
+        match = PARTITION_PATTERN.search(path)
+        if match and os.path.isdir(path):
+            found.append((int(match.group(1)), int(match.group(2)), path))
+    return sorted(found)
+
+
+def partition_files(root, start=None, end=None):
+    '''
+    Input: root of a partitioned layout and the [start, end) date range (None: open)
+    Output: (Parquet files of the months overlapping the range, number of partitions skipped)
+    '''
+    first = pd.Timestamp(start).to_period('M') if start is not None else None
+    # The end is exclusive: a range ending on the 1st at midnight does not need that month
+    last = (pd.Timestamp(end) - pd.Timedelta(1, 'us')).to_period('M') if end is not None else None
+    files, skipped = [], 0
+    for year, month, path in partitions(root):
+        period = pd.Period(year=year, month=month, freq='M')
+        if (first is not None and period < first) or (last is not None and period > last):
+            skipped += 1
+            continue
+        files.extend(sorted(glob.glob(os.path.join(glob.escape(path), '*.parquet'))))
+    return files, skipped
+
+
+def write_partitioned(data, root, chunksize=1_000_000):
+    '''
+    Input: typed assessments dataframe, or a CSV export / directory of partitions
+           read chunk by chunk (see streaming.iter_chunks), the root directory
+           and the rows per chunk
+    Output: sorted list of (year, month) partitions written; they replace any
+            previous content of those months
+    '''
+    if pyarrow is None:
+        raise ImportError("Writing partitions needs pyarrow")
+    if isinstance(data, pd.DataFrame):
+        chunks = [data]
+    else:
+        from streaming import iter_chunks
+        chunks = iter_chunks(data, chunksize)
+
+    partitioning = pyarrow.dataset.partitioning(
+        pyarrow.schema([('year', pyarrow.int16()), ('month', pyarrow.int8())]), flavor='hive'
+        )
+    written = set()
+    for number, chunk in enumerate(chunks):
+        if not len(chunk):
+            continue
+        dates = chunk['date'].dt
+        keys = pd.DataFrame({'year': dates.year.astype(np.int16), 'month': dates.month.astype(np.int8)})
+        for year, month in keys.drop_duplicates().itertuples(index=False):
+            if (year, month) not in written:
+                # First data for this month in this run: drop what an earlier run wrote there
+                shutil.rmtree(partition_dir(root, year, month), ignore_errors=True)
+                written.add((int(year), int(month)))
+        table = pyarrow.Table.from_pandas(
+            pd.concat([chunk[COLUMNS].reset_index(drop=True), keys.reset_index(drop=True)], axis=1),
+            preserve_index=False,
+            )
+        pyarrow.dataset.write_dataset(
+            table, root, format='parquet', partitioning=partitioning,
+            basename_template=f"part-{number}-{{i}}.parquet", existing_data_behavior='overwrite_or_ignore',
+            max_rows_per_group=ROW_GROUP_SIZE, min_rows_per_group=min(ROW_GROUP_SIZE, len(table)),
+            )
+    return sorted(written)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('source', help="CSV export or directory of CSV/Parquet files")
+    parser.add_argument('root')
+    parser.add_argument('--chunksize', type=int, default=1_000_000)
+    args = parser.parse_args()
+    written = write_partitioned(args.source, args.root, args.chunksize)
+    print(f"{len(written)} monthly partitions written to {args.root}")
+
+
+if __name__ == '__main__':
+    main()
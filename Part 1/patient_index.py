@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Patient timeline store
+
+The assessments are sorted once by (patient_id, date) and an offsets array marks
+where each patient's records start, so the history of any patient is the
+contiguous slice frame[offsets[i]:offsets[i + 1]]. Looking a patient up is a single
+array access when the ids are dense enough (the usual case for integer ids) and a
+binary search otherwise. No boolean mask over the full frame is ever built.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class PatientIndex:
+    '''
+    Per-patient timelines over an assessments dataframe
+    Input: assessments dataframe with 'patient_id' and 'date' columns
+    Example: PatientIndex(df).get(10687) -> records of patient 10687 sorted by date
+    '''
+
+    def __init__(self, df, patient_column='patient_id', date_column='date'):
+        patient_ids = df[patient_column].values
+        order = np.lexsort((df[date_column].values, patient_ids))
+        self.patient_column = patient_column
+        self.frame = df.iloc[order].reset_index(drop=True)
+        sorted_ids = patient_ids[order]
+        # First row of each patient in the sorted frame, plus the end of the frame
+        starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]][:len(sorted_ids)])
+        self.ids = sorted_ids[starts]
+        self.offsets = np.append(starts, len(sorted_ids)).astype(np.int64)
+        # Dense id -> position table for O(1) lookups when the ids are small non-negative integers
+        # (at most 8 slots per patient, or 16 MB)
+        self._dense = None
+        if len(self.ids) and self.ids[0] >= 0 and self.ids[-1] < max(8 * len(self.ids), 1 << 22):
+            self._dense = np.full(int(self.ids[-1]) + 1, -1, dtype=np.int32)
+            self._dense[self.ids] = np.arange(len(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, patient_id):
+        return self.position(patient_id) >= 0
+
+    def positions(self, patient_ids):
+        '''
+        Input: array-like of patient ids
+        Output: position of each patient in self.ids, -1 for unknown patients
+        '''
+        patient_ids = np.asarray(patient_ids, dtype=np.int64)
+        if self._dense is not None:
+            known = (patient_ids >= 0) & (patient_ids < len(self._dense))
+            result = np.full(patient_ids.shape, -1, dtype=np.int64)
+            result[known] = self._dense[patient_ids[known]]
+            return result
+        result = np.searchsorted(self.ids, patient_ids)
+        found = result < len(self.ids)
+        found[found] = self.ids[result[found]] == patient_ids[found]
+        return np.where(found, result, -1)
+
+    def position(self, patient_id):
+        return int(self.positions([patient_id])[0])
+
+    def bounds(self, patient_id):
+        '''
+        Input: patient id
+        Output: (start, stop) rows of the patient in self.frame, (0, 0) if unknown
+        '''
+        pos = self.position(patient_id)
+        if pos < 0:
+            return 0, 0
+        return int(self.offsets[pos]), int(self.offsets[pos + 1])
+
+    def get(self, patient_id):
+        '''
+        Input: patient id
+        Output: slice of self.frame with the patient's records sorted by date
+                (empty dataframe for an unknown patient)
+        '''
+        start, stop = self.bounds(patient_id)
+        return self.frame.iloc[start:stop]
+
+    def get_many(self, patient_ids):
+        '''
+        Input: list of patient ids
+        Output: list with one slice per patient, in the same order
+        '''
+        return [self.get(patient_id) for patient_id in patient_ids]
+
+    def take(self, patient_ids):
+        '''
+        Input: list of patient ids
+        Output: one dataframe with the records of all the patients, grouped by
+                patient in the requested order
+        '''
+        pos = self.positions(patient_ids)
+        pos = pos[pos >= 0]
+        starts, stops = self.offsets[pos], self.offsets[pos + 1]
+        lengths = stops - starts
+        # Row numbers of all the requested ranges without a Python loop
+        rows = np.repeat(starts - np.cumsum(np.r_[0, lengths[:-1]]), lengths) + np.arange(lengths.sum())
+        return self.frame.iloc[rows]
+
+    def counts(self):
+        '''
+        Output: series with the number of records per patient, indexed by patient id
+        '''
+        return pd.Series(np.diff(self.offsets), index=pd.Index(self.ids, name=self.patient_column), name='times_taken')
+
+    def top(self, n):
+        '''
+        Input: number of patients
+        Output: ids of the n patients with the most records (ties by lowest id)
+        '''
+        order = np.lexsort((self.ids, -np.diff(self.offsets)))
+        return self.ids[order[:n]].tolist()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Calendar dimension shared by every monthly aggregation
+
+The calendar columns are derived once per dataset, straight from the datetime64
+values: the month key is the number of months since the epoch, so year, month and
+the 'Month Year' label are all plain integer arithmetic on that key. Labels are
+only built for the handful of distinct months and stored as categoricals, which
+keeps the per-row cost at a couple of small integer codes.
+"""
+
+import calendar
+
+import numpy as np
+import pandas as pd
+
+
+# Columns added by add_calendar, in the order used for monthly groupbys
+MONTH_KEYS = ['Month Year', 'month', 'year']
+
+
+def month_label(period):
+    '''
+    Input: pandas monthly Period
+    Output: 'Month Year' label
+    Example: Period('2019-06', 'M') -> 'Jun 2019'
+    '''
+    return f"{calendar.month_abbr[period.month]} {period.year}"
+
+
+def month_index(dates):
+    '''
+    Input: datetime64 series or array
+    Output: int64 array with the number of months since January 1970
+    Example: 2019-06-18 13:32:43 -> 593
+    '''
+    return np.asarray(dates, dtype='datetime64[ns]').astype('datetime64[M]').astype('int64')
+
+
+def add_calendar(df, column='date'):
+    '''
+    Input: dataframe with a datetime64 column
+    Output: the same dataframe with 'period', 'year', 'month' and 'Month Year'
+            columns added in place, all of them categoricals ordered by time
+    '''
+    months = month_index(df[column])
+    if len(months) == 0:
+        first = last = 0
+    else:
+        first, last = int(months.min()), int(months.max())
+    # Every month between the first and last assessment, in calendar order
+    periods = pd.period_range(
+        pd.Period(year=1970 + first // 12, month=first % 12 + 1, freq='M'),
+        periods=last - first + 1, freq='M'
+        )
+    codes = months - first
+    code_dtype = np.int16 if len(periods) < np.iinfo(np.int16).max else np.int32
+    first_year = 1970 + first // 12
+
+    df['period'] = pd.Categorical.from_codes(codes.astype(code_dtype), categories=periods, ordered=True)
+    df['year'] = pd.Categorical.from_codes(
+        (months // 12 - first // 12).astype(code_dtype),
+        categories=range(first_year, periods[-1].year + 1), ordered=True
+        )
+    df['month'] = pd.Categorical.from_codes((months % 12).astype(np.int8), categories=range(1, 13), ordered=True)
+    df['Month Year'] = pd.Categorical.from_codes(
+        codes.astype(code_dtype), categories=[month_label(p) for p in periods], ordered=True
+        )
+    return df
+
+
+def calendar_frame(df, codes):
+    '''
+    Input: dataframe carrying the add_calendar columns and an array of month codes
+           (positions in the 'period' categories)
+    Output: small dataframe with one row per code and the calendar columns,
+            sharing the categorical dtypes of df
+    '''
+    codes = np.asarray(codes)
+    periods = df['period'].cat.categories[codes]
+    return pd.DataFrame({
+        'period': pd.Categorical.from_codes(codes, dtype=df['period'].dtype),
+        'Month Year': pd.Categorical.from_codes(codes, dtype=df['Month Year'].dtype),
+        'month': pd.Categorical(periods.month, dtype=df['month'].dtype),
+        'year': pd.Categorical(periods.year, dtype=df['year'].dtype),
+        })
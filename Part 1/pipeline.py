@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""The Part 1 analysis as named, instrumented stages
+
+Each Stage takes and returns the dict holding the intermediate results (the
+assessments frame, the Report, the PatientIndex, ...) and names the results it
+reads and produces. run_stages() runs them in order and records for every stage:
+
+*   wall and CPU time (time.perf_counter / time.process_time),
+*   rows in (rows of the result the stage reads) and rows out (of the one it produces),
+*   peak resident memory of the process and how much the stage raised it
+    (getrusage, on Unix), and optionally the peak of the memory traced by
+    tracemalloc during the stage (slower, off by default),
+*   optionally a cProfile dump per stage (<profile_dir>/<nn>-<stage>.prof, open it
+    with pstats or snakeviz).
+
+The records are plain dicts: save them as JSON with --json, or as a Chrome/Perfetto
+trace with --trace to see the stages on a timeline.
+
+Usage: python pipeline.py DATA_PATH [--json stages.json] [--trace trace.json] [--profile-dir profiles] [--tracemalloc]
+"""
+
+import argparse
+import cProfile
+import io
+import json
+import os
+import re
+import time
+import tracemalloc
+from collections import namedtuple
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from aggregates import aggregate, pivot_zones
+from alerts import patient_alerts
+from banding import GAD7_SEVERITY, GAD7_ZONES, add_bands
+from patient_index import PatientIndex
+from periods import add_calendar
+from validation import read_checked, validate
+
+
+# Name, function (state dict -> state dict) and the keys of the result it reads and of
+# the one it produces in the state (None: nothing)
+Stage = namedtuple('Stage', ['name', 'run', 'input', 'output'])
+
+
+def peak_rss_mb():
+    '''
+    Output: peak resident set size of the process so far in MB (None when unavailable)
+    '''
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def rows_of(value):
+    '''
+    Input: stage result
+    Output: number of rows (len for frames and indexes, the sum for a Report), None otherwise
+    '''
+    if isinstance(value, tuple) and hasattr(value, '_fields'):
+        return sum(len(table) for table in value if table is not None)
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+
+def plot_report(report, patients):
+    '''
+    Input: Report and PatientIndex
+    Output: None, draws the monthly chart and the chart of the most frequent test
+            taker into memory with the Agg backend
+    '''
+    import matplotlib.pyplot as plt
+
+    from charts import plot_scores
+
+    fig, ax = plt.subplots(1, 1, figsize=(15, 8))
+    ax.plot(report.monthly['Month Year'].astype(str), report.monthly['Assessments Count'])
+    fig.savefig(io.BytesIO(), format='png')
+    plt.close(fig)
+    patient_id = patients.top(1)[0]
+    records = patients.get(patient_id)
+    fig, ax = plt.subplots(1, 1, figsize=(15, 8))
+    plot_scores(ax, records['date'], records['score'], patient_id)
+    fig.savefig(io.BytesIO(), format='png')
+    plt.close(fig)
+
+
+def analysis_stages(path, cache=True, cache_dir=None):
+    '''
+    Input: path to the raw CSV export and the loader's cache options
+    Output: list of the Stages of the analysis, in order
+    '''
+    def load(state):
+        state['df'] = read_checked(path, cache=cache, cache_dir=cache_dir)
+        return state
+
+    def validation(state):
+        state['df'], state['quarantine'], state['quality'] = validate(state['df'])
+        return state
+
+    def calendar_stage(state):
+        add_calendar(state['df'])
+        return state
+
+    def banding(state):
+        add_bands(state['df'], [GAD7_ZONES, GAD7_SEVERITY])
+        return state
+
+    def grouping(state):
+        state['report'] = aggregate(state['df'], dimension='zone')
+        return state
+
+    def pivot(state):
+        state['zone_pivot'] = pivot_zones(state['report'].zones)
+        return state
+
+    def patient_index(state):
+        state['patients'] = PatientIndex(state['df'])
+        return state
+
+    def alerting(state):
+        state['alerts'] = patient_alerts(state['df'])
+        return state
+
+    def plotting(state):
+        plot_report(state['report'], state['patients'])
+        return state
+
+    return [
+        Stage('load', load, None, 'df'),
+        Stage('validation', validation, 'df', 'df'),
+        Stage('calendar', calendar_stage, 'df', 'df'),
+        Stage('banding', banding, 'df', 'df'),
+        Stage('grouping', grouping, 'df', 'report'),
+        Stage('pivot', pivot, 'report', 'zone_pivot'),
+        Stage('patient index', patient_index, 'df', 'patients'),
+        Stage('alerts', alerting, 'df', 'alerts'),
+        Stage('plotting', plotting, 'report', None),
+        ]
+
+
+def run_stages(stages, state=None, trace_memory=False, profile_dir=None):
+    '''
+    Input: list of Stages, initial state dict, whether to trace allocations with
+           tracemalloc and the directory for per-stage cProfile dumps (None: no profiling)
+    Output: (final state, list of one record dict per stage)
+    '''
+    state = {} if state is None else state
+    records = []
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    origin = time.perf_counter()
+    try:
+        for number, stage in enumerate(stages, start=1):
+            rows_in = rows_of(state.get(stage.input)) if stage.input else None
+            rss_before = peak_rss_mb()
+            if trace_memory:
+                tracemalloc.reset_peak()
+                traced_before, _ = tracemalloc.get_traced_memory()
+            profiler = cProfile.Profile() if profile_dir else None
+            start, cpu_start = time.perf_counter(), time.process_time()
+            if profiler:
+                profiler.enable()
+            state = stage.run(state)
+            if profiler:
+                profiler.disable()
+            wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+
+            rows_out = rows_of(state.get(stage.output)) if stage.output else None
+            record = {
+                'stage': stage.name,
+                'start': round(start - origin, 6),
+                'wall_seconds': round(wall, 6),
+                'cpu_seconds': round(cpu, 6),
+                'rows_in': rows_in,
+                'rows_out': rows_out,
+            }
+            rss_after = peak_rss_mb()
+            if rss_after is not None:
+                record['peak_rss_mb'] = round(rss_after, 2)
+                record['rss_growth_mb'] = round(rss_after - rss_before, 2)
+            if trace_memory:
+                _, traced_peak = tracemalloc.get_traced_memory()
+                record['traced_peak_mb'] = round((traced_peak - traced_before) / 2**20, 2)
+            if profiler:
+                slug = re.sub(r'\W+', '_', stage.name).strip('_')
+                record['profile'] = os.path.join(profile_dir, f"{number:02d}-{slug}.prof")
+                profiler.dump_stats(record['profile'])
+            records.append(record)
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+    return state, records
+
+
+def to_trace(records):
+    '''
+    Input: stage records from run_stages
+    Output: dict in the Chrome trace event format (chrome://tracing, ui.perfetto.dev)
+    '''
+    return {'traceEvents': [
+        {
+            'name': record['stage'], 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+            'ts': record['start'] * 1e6, 'dur': record['wall_seconds'] * 1e6,
+            'args': {key: value for key, value in record.items() if key not in ('stage', 'start')},
+        }
+        for record in records
+        ]}
+
+
+def format_records(records):
+    '''
+    Input: stage records from run_stages
+    Output: text table with one line per stage
+    '''
+    lines = [f"{'stage':<15} {'wall':>9} {'cpu':>9} {'rows in':>12} {'rows out':>12} {'peak rss':>10}"]
+    for record in records:
+        rows_in = f"{record['rows_in']:,}" if record['rows_in'] is not None else '-'
+        rows_out = f"{record['rows_out']:,}" if record['rows_out'] is not None else '-'
+        rss = f"{record['peak_rss_mb']:.0f} MB" if 'peak_rss_mb' in record else '-'
+        line = (f"{record['stage']:<15} {record['wall_seconds']:>8.3f}s {record['cpu_seconds']:>8.3f}s "
+                f"{rows_in:>12} {rows_out:>12} {rss:>10}")
+        if 'traced_peak_mb' in record:
+            line += f" {record['traced_peak_mb']:>9.1f} MB traced"
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('data_path')
+    parser.add_argument('--json', help="save the stage records to this file")
+    parser.add_argument('--trace', help="save a Chrome/Perfetto trace to this file")
+    parser.add_argument('--profile-dir', help="dump a cProfile file per stage in this directory")
+    parser.add_argument('--tracemalloc', action='store_true', help="record the traced memory peak of every stage")
+    parser.add_argument('--no-cache', action='store_true', help="always parse the CSV")
+    args = parser.parse_args()
+
+    import matplotlib
+    matplotlib.use('Agg')
+
+    _, records = run_stages(
+        analysis_stages(args.data_path, cache=not args.no_cache),
+        trace_memory=args.tracemalloc, profile_dir=args.profile_dir,
+        )
+    print(format_records(records))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(records, f, indent=2)
+    if args.trace:
+        with open(args.trace, 'w') as f:
+            json.dump(to_trace(records), f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Lazy queries over the assessments
+
+A Query only records what is asked for; nothing is read until collect():
+
+    Query('phq_all_final.csv').where(year=2020).patients([10687, 6574]).select('date', 'score').collect()
+
+When the data is in Parquet (the loader's cache, a directory of Parquet files or
+the year=/month= partitions of partitions.py, whose months outside the date range
+are skipped before any file is opened) the filters are handed to pyarrow.dataset as one expression and the selected
+columns as the projection, so the reader skips the row groups whose date or
+patient_id statistics cannot match and never decodes the other columns. Years and
+months become date ranges, which is what the row-group statistics can prune on.
+Without pyarrow, or for a dataframe already in memory, the same plan runs as
+pandas masks.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from loader import COLUMNS, cache_path, load_assessments, pyarrow
+from partitions import partition_files, partitions
+
+if pyarrow is not None:
+    import pyarrow.dataset
+
+
+def date_bounds(year=None, month=None, start=None, end=None):
+    '''
+    Input: calendar year and month (1-12, needs a year) and/or an explicit
+           [start, end) range, anything pd.Timestamp accepts
+    Output: (start, end) timestamps of the intersection, None for an open side
+    Example: year=2020, month=2 -> (Timestamp('2020-02-01'), Timestamp('2020-03-01'))
+    '''
+    lower = pd.Timestamp(start) if start is not None else None
+    upper = pd.Timestamp(end) if end is not None else None
+    if month is not None and year is None:
+        raise ValueError("month needs a year")
+    if year is not None:
+        first = pd.Timestamp(year=year, month=month or 1, day=1)
+        last = first + (pd.DateOffset(months=1) if month else pd.DateOffset(years=1))
+        lower = first if lower is None else max(lower, first)
+        upper = last if upper is None else min(upper, last)
+    return lower, upper
+
+
+class Query:
+    '''
+    Immutable, lazily evaluated query over the assessments
+    Input: raw CSV export (queried through its Parquet cache), Parquet file or
+           directory, or an assessments dataframe
+    Example: Query(path).where(year=2019).select('date').collect()
+    '''
+
+    def __init__(self, source, start=None, end=None, patient_ids=None, types=None, columns=None):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.patient_ids = patient_ids
+        self.types = types
+        self.columns = columns
+
+    def _replace(self, **changes):
+        spec = dict(start=self.start, end=self.end, patient_ids=self.patient_ids,
+                    types=self.types, columns=self.columns)
+        spec.update(changes)
+        return Query(self.source, **spec)
+
+    def where(self, year=None, month=None, start=None, end=None, type=None):
+        '''
+        Input: calendar year/month, [start, end) dates and assessment type(s);
+               combined with the filters already set
+        Output: new Query
+        '''
+        lower, upper = date_bounds(year, month, start, end)
+        if self.start is not None:
+            lower = self.start if lower is None else max(lower, self.start)
+        if self.end is not None:
+            upper = self.end if upper is None else min(upper, self.end)
+        types = self.types
+        if type is not None:
+            new_types = [type] if isinstance(type, str) else list(type)
+            types = new_types if types is None else [t for t in types if t in new_types]
+        return self._replace(start=lower, end=upper, types=types)
+
+    def patients(self, patient_ids):
+        '''
+        Input: list of patient ids, intersected with the ones already set
+        Output: new Query
+        '''
+        ids = np.unique(np.asarray(patient_ids, dtype=np.int64))
+        if self.patient_ids is not None:
+            ids = np.intersect1d(ids, self.patient_ids)
+        return self._replace(patient_ids=ids)
+
+    def select(self, *columns):
+        '''
+        Input: column names to return (all of them when never called)
+        Output: new Query
+        '''
+        unknown = [column for column in columns if column not in COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown columns: {unknown}, expected some of {COLUMNS}")
+        return self._replace(columns=list(columns))
+
+    def _dataset_path(self):
+        '''
+        Output: Parquet file or directory to read, None to run the plan with pandas
+        '''
+        if isinstance(self.source, pd.DataFrame) or pyarrow is None:
+            return None
+        if os.path.isdir(self.source) or self.source.endswith('.parquet'):
+            return self.source
+        # Raw export: read its Parquet cache, written on first use
+        path = cache_path(self.source)
+        if not os.path.exists(path):
+            load_assessments(self.source)
+        return path
+
+    def _dataset(self, path):
+        '''
+        Input: Parquet file or directory
+        Output: (pyarrow dataset to scan, number of partitions pruned)
+        '''
+        if not (os.path.isdir(path) and partitions(path)):
+            return pyarrow.dataset.dataset(path, format='parquet'), 0
+        files, skipped = partition_files(path, self.start, self.end)
+        if not files:
+            # Every partition pruned: an empty dataset with the layout's schema
+            schema = pyarrow.dataset.dataset(partition_files(path)[0][0], format='parquet').schema
+            return pyarrow.dataset.dataset([], format='parquet', schema=schema), skipped
+        return pyarrow.dataset.dataset(files, format='parquet'), skipped
+
+    def filter_expression(self):
+        '''
+        Output: pyarrow.dataset expression of the filters (None when unfiltered)
+        '''
+        field = pyarrow.dataset.field
+        terms = []
+        if self.start is not None:
+            terms.append(field('date') >= self.start.to_pydatetime())
+        if self.end is not None:
+            terms.append(field('date') < self.end.to_pydatetime())
+        if self.patient_ids is not None:
+            terms.append(field('patient_id').isin(self.patient_ids.tolist()))
+        if self.types is not None:
+            terms.append(field('type').isin(self.types))
+        expression = None
+        for term in terms:
+            expression = term if expression is None else expression & term
+        return expression
+
+    def _collect_frame(self, df):
+        mask = np.ones(len(df), dtype=bool)
+        if self.start is not None:
+            mask &= (df['date'] >= self.start).values
+        if self.end is not None:
+            mask &= (df['date'] < self.end).values
+        if self.patient_ids is not None:
+            mask &= np.isin(df['patient_id'].values, self.patient_ids)
+        if self.types is not None:
+            mask &= df['type'].isin(self.types).values
+        return df.loc[mask, self.columns or COLUMNS].reset_index(drop=True)
+
+    def explain(self):
+        '''
+        Output: text description of the plan
+        '''
+        path = self._dataset_path()
+        source = 'dataframe' if isinstance(self.source, pd.DataFrame) else path or self.source
+        lines = [f"source: {source}"]
+        lines.append(f"columns: {self.columns or COLUMNS}")
+        if path is not None:
+            dataset, skipped = self._dataset(path)
+            if skipped:
+                lines.append(f"partitions pruned: {skipped}, files read: {len(dataset.files)}")
+            lines.append(f"pushed-down filter: {self.filter_expression()}")
+        else:
+            lines.append("filter: pandas masks")
+        return '\n'.join(lines)
+
+    def collect(self):
+        '''
+        Output: dataframe of the matching assessments with the selected columns
+        '''
+        path = self._dataset_path()
+        if path is None:
+            source = self.source if isinstance(self.source, pd.DataFrame) else load_assessments(self.source)
+            return self._collect_frame(source)
+        dataset, _ = self._dataset(path)
+        table = dataset.to_table(columns=self.columns or COLUMNS, filter=self.filter_expression())
+        return table.to_pandas()
+
+    def count(self):
+        '''
+        Output: number of matching assessments
+        '''
+        path = self._dataset_path()
+        if path is None:
+            return len(self._replace(columns=['patient_id']).collect())
+        dataset, _ = self._dataset(path)
+        return dataset.count_rows(filter=self.filter_expression())
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""Memoized analytics results
+
+Results (zone_pivot, the top of patient_count, patient timelines, ...) are cached
+under a content address: the SHA-256 of the dataset name, the dataset version and
+the query parameters. The memory tier is an LRU bounded in bytes; with a disk
+directory, results are also pickled there (bounded too, oldest files removed
+first) and promoted back to memory on a hit, so they survive restarts.
+
+The version comes from the data itself: the incremental state's version number
+(incremental.py increments it on every refresh that ingests new rows, a rebuild
+included, and leaves it alone otherwise) or the source file's mtime and size. A
+new version gives new keys, and as soon as a dataset is seen with a new version
+the entries of its older versions are dropped from both tiers.
+
+CachedAnalytics serves the script's repeated questions through a cache: the zone
+pivot and the top of patient_count from the incremental state, and the patient
+timelines from the assessments (through query.Query).
+
+Usage: python result_cache.py STATE_DIR [--source DATA_PATH] [--disk-dir DIR] [--repeat 5]
+"""
+
+import argparse
+import copy
+import hashlib
+import json
+import os
+import pickle
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from incremental import STATE_META, AggregateState, report_tables
+from query import Query
+
+
+def dataset_version(source):
+    '''
+    Input: incremental state directory, data file, or directory of data files
+    Output: version string that changes whenever the data changes
+    Example: 'state/' -> 'state-12'; 'phq_all_final.csv' -> 'file-1595980800000000000-5242880'
+    '''
+    meta_path = os.path.join(source, STATE_META)
+    if os.path.isdir(source) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            return f"state-{json.load(f)['version']}"
+    if os.path.isdir(source):
+        stats = [os.stat(os.path.join(root, name)) for root, _, names in os.walk(source) for name in names]
+        digest = hashlib.sha256(repr(sorted((s.st_mtime_ns, s.st_size) for s in stats)).encode()).hexdigest()
+        return f"dir-{len(stats)}-{digest[:16]}"
+    stat = os.stat(source)
+    return f"file-{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def _canonical(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (np.generic, pd.Timestamp)):
+        return str(value)
+    raise TypeError(f"Cannot use {type(value).__name__} as a cache key parameter")
+
+
+def result_key(dataset, version, name, params):
+    '''
+    Input: dataset name, dataset version, result name and dict of query parameters
+    Output: hex SHA-256 content address of the result
+    '''
+    payload = json.dumps([dataset, version, name, params], sort_keys=True, default=_canonical)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def size_of(value):
+    '''
+    Input: cached result
+    Output: approximate size in bytes
+    '''
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        usage = value.memory_usage(deep=True, index=True)
+        return int(usage.sum()) if isinstance(value, pd.DataFrame) else int(usage)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(size_of(item) for item in value)
+    return sys.getsizeof(value)
+
+
+def private_copy(value):
+    '''
+    Input: result
+    Output: copy the caller can modify without changing the cached entry
+    Example: pivot = cache.get(...)[0]; pivot[cols] = pivot[cols] * 100 leaves the entry as it was
+    '''
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index, np.ndarray)):
+        return value.copy()
+    return copy.deepcopy(value)
+
+
+class ResultCache:
+    '''
+    LRU result cache with a byte bound and an optional disk tier
+    Input: memory bound in bytes, disk directory (None: memory only) and disk bound in bytes
+    '''
+
+    def __init__(self, max_bytes=256 * 2**20, disk_dir=None, disk_max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        # key -> (value, size, dataset, version), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._versions = {}
+        self.metrics = {'hits': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + '.pkl')
+
+    def _observe(self, dataset, version):
+        '''
+        Drops the entries of the other versions of the dataset when it shows up with a
+        new version (or for the first time: the disk may hold results of earlier runs)
+        '''
+        if self._versions.get(dataset) == version:
+            return
+        stale = [key for key, entry in self._entries.items() if entry[2] == dataset and entry[3] != version]
+        for key in stale:
+            self._bytes -= self._entries.pop(key)[1]
+        self.metrics['invalidations'] += len(stale)
+        if self.disk_dir:
+            for name in os.listdir(self.disk_dir):
+                path = os.path.join(self.disk_dir, name)
+                try:
+                    with open(path, 'rb') as f:
+                        header = pickle.load(f)
+                except (OSError, EOFError, pickle.UnpicklingError):
+                    continue
+                if header[0] == dataset and header[1] != version:
+                    os.remove(path)
+                    # An entry in both tiers counts once
+                    self.metrics['invalidations'] += name[:-len('.pkl')] not in stale
+        self._versions[dataset] = version
+
+    def _store(self, key, value, size, dataset, version):
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size, dataset, version)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted_size, _, _) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.metrics['evictions'] += 1
+
+    def _write_disk(self, key, value, dataset, version):
+        tmp = self._disk_path(key) + '.tmp'
+        with open(tmp, 'wb') as f:
+            # Header first, so invalidation can read it without loading the result
+            pickle.dump((dataset, version), f)
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self._disk_path(key))
+        files = [os.path.join(self.disk_dir, name) for name in os.listdir(self.disk_dir) if name.endswith('.pkl')]
+        files.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in files)
+        for path in files:
+            if total <= self.disk_max_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                pickle.load(f)
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None, False
+        # Recently used files are the last ones removed
+        os.utime(path)
+        return value, True
+
+    def get(self, dataset, version, name, params):
+        '''
+        Input: dataset name, dataset version, result name and query parameters
+        Output: (copy of the cached result, True) or (None, False)
+        '''
+        self._observe(dataset, version)
+        key = result_key(dataset, version, name, params)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.metrics['hits'] += 1
+            self.metrics['memory_hits'] += 1
+            return private_copy(self._entries[key][0]), True
+        if self.disk_dir:
+            value, found = self._read_disk(key)
+            if found:
+                self._store(key, value, size_of(value), dataset, version)
+                self.metrics['hits'] += 1
+                self.metrics['disk_hits'] += 1
+                return private_copy(value), True
+        self.metrics['misses'] += 1
+        return None, False
+
+    def put(self, dataset, version, name, params, value):
+        '''
+        Input: dataset name, dataset version, result name, query parameters and the result
+        Output: the result; the cache keeps its own copy
+        '''
+        self._observe(dataset, version)
+        key = result_key(dataset, version, name, params)
+        self._store(key, private_copy(value), size_of(value), dataset, version)
+        if self.disk_dir:
+            self._write_disk(key, value, dataset, version)
+        return value
+
+    def get_or_compute(self, dataset, version, name, params, compute):
+        '''
+        Input: dataset name, dataset version, result name, query parameters and a
+               function computing the result from the parameters (called on a miss)
+        Output: the result
+        '''
+        value, found = self.get(dataset, version, name, params)
+        if found:
+            return value
+        return self.put(dataset, version, name, params, compute(**params))
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+        if self.disk_dir:
+            for name in os.listdir(self.disk_dir):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(self.disk_dir, name))
+
+    def stats(self):
+        '''
+        Output: dict of the hit/miss counters, hit rate, entries and bytes in memory
+        '''
+        lookups = self.metrics['hits'] + self.metrics['misses']
+        return dict(
+            self.metrics, hit_rate=self.metrics['hits'] / lookups if lookups else 0.0,
+            entries=len(self._entries), bytes=self._bytes,
+            )
+
+
+class CachedAnalytics:
+    '''
+    Cached answers to the analysts' repeated questions
+    Input: incremental state directory, assessments source for the timelines
+           (CSV export, Parquet file or partitions; None: no timelines) and a ResultCache
+    Example: analytics = CachedAnalytics('state/', 'phq_all_final.csv')
+             analytics.zone_pivot(); analytics.patient_count(20); analytics.top_timelines(3)
+    '''
+
+    def __init__(self, state_dir, source=None, cache=None):
+        self.state_dir = state_dir
+        self.source = source
+        self.cache = cache if cache is not None else ResultCache()
+
+    def _table(self, name, n=None):
+        def compute(name, n):
+            table = report_tables(AggregateState.load(self.state_dir).report())[name]
+            return table if n is None else table.head(n)
+        # The version is read on every call, so a refresh is picked up at once
+        return self.cache.get_or_compute(
+            self.state_dir, dataset_version(self.state_dir), 'table', {'name': name, 'n': n}, compute
+            )
+
+    def zone_pivot(self):
+        return self._table('zone_pivot')
+
+    def patient_count(self, n=20):
+        '''
+        Input: number of patients (None: all)
+        Output: patients with the most assessments, most first
+        '''
+        return self._table('patient_count', n)
+
+    def timeline(self, patient_id):
+        '''
+        Input: patient id
+        Output: assessments of the patient ordered by date
+        '''
+        if self.source is None:
+            raise ValueError("Timelines need an assessments source")
+
+        def compute(patient_id):
+            rows = Query(self.source).patients([patient_id]).collect()
+            return rows.sort_values('date', kind='stable').reset_index(drop=True)
+        return self.cache.get_or_compute(
+            self.source, dataset_version(self.source), 'timeline', {'patient_id': int(patient_id)}, compute
+            )
+
+    def top_timelines(self, k=3):
+        '''
+        Input: number of patients
+        Output: dict of patient id -> timeline of the k patients with the most assessments
+        '''
+        top = self.patient_count(k)
+        return {int(patient_id): self.timeline(patient_id) for patient_id in top['patient_id']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('state_dir')
+    parser.add_argument('--source', help="assessments for the top patient timelines")
+    parser.add_argument('--disk-dir', help="also keep the results in this directory")
+    parser.add_argument('--max-mb', type=float, default=256)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    cache = ResultCache(int(args.max_mb * 2**20), args.disk_dir)
+    analytics = CachedAnalytics(args.state_dir, args.source, cache)
+    for number in range(1, args.repeat + 1):
+        start = time.perf_counter()
+        analytics.zone_pivot()
+        analytics.patient_count(20)
+        if args.source:
+            analytics.top_timelines(3)
+        print(f"round {number}: {time.perf_counter() - start:8.4f}s")
+    print(json.dumps(cache.stats(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Compact in-memory assessment store
+
+Assessments are kept as parallel typed arrays instead of a dataframe of Python
+objects:
+
+    patient_id              int32    4 bytes
+    score                   uint8    1 byte
+    date                    int64    8 bytes  (microseconds since 1970-01-01)
+    patient_date_created    int64    8 bytes  (microseconds since 1970-01-01)
+    type                    int8     1 byte   (index into ASSESSMENT_TYPES)
+
+that is 22 bytes per assessment, whatever the dates or labels look like. The raw
+export read by pandas without a schema takes 243 bytes per row with object strings
+for the type and both timestamps (96 with pandas' Arrow-backed strings). The date,
+id and score arrays convert to and from dataframes without copying when the dates
+are already datetime64[us] (what loader.py produces); only the 1-byte type codes
+are copied.
+"""
+
+import numpy as np
+import pandas as pd
+
+from loader import narrow_array
+
+
+# Assessment types and their codes (position in the list)
+ASSESSMENT_TYPES = ['gad7', 'phq9']
+
+FIELDS = ['date', 'patient_id', 'type', 'patient_date_created', 'score']
+
+DTYPES = {
+    'date': np.int64,
+    'patient_id': np.int32,
+    'type': np.int8,
+    'patient_date_created': np.int64,
+    'score': np.uint8,
+}
+
+# Resolution of the stored timestamps
+TIME_UNIT = 'us'
+
+
+def _epoch(values):
+    '''
+    Input: datetime-like series or array
+    Output: int64 array of microseconds since the epoch (a view when already datetime64[us])
+    '''
+    values = np.asarray(values)
+    if values.dtype != f'datetime64[{TIME_UNIT}]':
+        values = pd.to_datetime(values).values.astype(f'datetime64[{TIME_UNIT}]')
+    return values.view(np.int64)
+
+
+def _type_codes(values):
+    '''
+    Input: series of assessment type names (categorical or strings)
+    Output: int8 array of codes into ASSESSMENT_TYPES
+    '''
+    if isinstance(values.dtype, pd.CategoricalDtype) and list(values.cat.categories) == ASSESSMENT_TYPES:
+        codes = values.cat.codes.values
+    else:
+        codes = pd.Categorical(values, categories=ASSESSMENT_TYPES).codes
+    codes = codes.astype(np.int8, copy=False)
+    unknown = (codes < 0) & pd.notna(values).values
+    if unknown.any():
+        raise ValueError(f"Unknown assessment types: {sorted(pd.unique(values[unknown]))}, "
+                         f"expected one of {ASSESSMENT_TYPES}")
+    return codes
+
+
+class AssessmentStore:
+    '''
+    Assessments as parallel typed arrays (see the module docstring for the layout)
+    Input: the arrays, by field name
+    Example: store = AssessmentStore.from_frame(df)
+             store.nbytes / len(store) -> 22.0
+             store.to_frame() -> dataframe with the loader's dtypes
+    '''
+
+    __slots__ = FIELDS
+
+    def __init__(self, date, patient_id, type, patient_date_created, score):
+        arrays = dict(date=date, patient_id=patient_id, type=type,
+                      patient_date_created=patient_date_created, score=score)
+        lengths = {len(array) for array in arrays.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"Arrays have different lengths: {sorted(lengths)}")
+        for field, array in arrays.items():
+            # Checked cast: an id or score that does not fit raises SchemaError instead of wrapping
+            setattr(self, field, narrow_array(array, DTYPES[field], field))
+
+    @classmethod
+    def from_frame(cls, df):
+        '''
+        Input: assessments dataframe (raw or typed, columns as in the export)
+        Output: AssessmentStore
+        '''
+        return cls(
+            date=_epoch(df['date']),
+            patient_id=df['patient_id'],
+            type=_type_codes(df['type']),
+            patient_date_created=_epoch(df['patient_date_created']),
+            score=df['score'],
+            )
+
+    def to_frame(self):
+        '''
+        Output: dataframe with the loader's dtypes (datetime64[us] dates, int32 ids,
+                uint8 scores, categorical type), sharing memory with the arrays
+        '''
+        return pd.DataFrame({
+            'date': self.date.view(f'datetime64[{TIME_UNIT}]'),
+            'patient_id': self.patient_id,
+            'type': pd.Categorical.from_codes(self.type, categories=ASSESSMENT_TYPES),
+            'patient_date_created': self.patient_date_created.view(f'datetime64[{TIME_UNIT}]'),
+            'score': self.score,
+            }, copy=False)
+
+    def __len__(self):
+        return len(self.score)
+
+    def __getitem__(self, rows):
+        '''
+        Input: slice, integer positions or boolean mask
+        Output: AssessmentStore of those rows (a view for slices)
+        '''
+        return AssessmentStore(**{field: getattr(self, field)[rows] for field in FIELDS})
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, field).nbytes for field in FIELDS)
+
+    @staticmethod
+    def bytes_per_row():
+        return sum(np.dtype(dtype).itemsize for dtype in DTYPES.values())
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""Streaming (chunked) ingestion for exports larger than memory
+
+The assessments are read chunk by chunk, from one CSV export or from a directory of
+daily partitions, and folded into running accumulators:
+
+*   assessments per day and per month (integer arrays indexed by day/month number),
+*   assessments per patient,
+*   distinct (month, patient) pairs for the monthly patients count (or, with
+    distinct_error, daily HyperLogLog sketches of the patients, see hll.py),
+*   assessments per month and band label (e.g. score zone).
+
+Memory depends on the number of distinct days, months and patients, never on the
+number of rows, and StreamingAggregator.report() returns exactly the tables that
+aggregates.aggregate() computes on the whole frame in memory (the monthly patients
+count is an estimate when sketches are used).
+"""
+
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+from aggregates import Report
+from banding import GAD7_ZONES
+from hll import DailySketches
+from loader import iter_assessments_csv, parse_dates
+from periods import add_calendar, calendar_frame, month_index
+
+
+def iter_chunks(source, chunksize=1_000_000):
+    '''
+    Input: path to a CSV export, or to a directory of partitions (*.csv and/or
+           *.parquet files, read in name order), and the number of rows per chunk
+    Output: iterator of typed assessments dataframes
+    '''
+    if not os.path.isdir(source):
+        yield from iter_assessments_csv(source, chunksize)
+        return
+    paths = sorted(glob.glob(os.path.join(glob.escape(source), '*.csv')) +
+                   glob.glob(os.path.join(glob.escape(source), '*.parquet')))
+    for path in paths:
+        if path.endswith('.csv'):
+            yield from iter_assessments_csv(path, chunksize)
+        else:
+            chunk = pd.read_parquet(path)
+            if not pd.api.types.is_datetime64_any_dtype(chunk['date']):
+                chunk = parse_dates(chunk)
+            yield chunk
+
+
+def _add_counts(total, counts):
+    '''
+    Input: accumulated count array and the counts of a new chunk (both indexed from 0
+           along the first axis)
+    Output: accumulated counts, grown to fit the new chunk if needed
+    '''
+    if len(counts) > len(total):
+        counts[:len(total)] += total
+        return counts
+    total[:len(counts)] += counts
+    return total
+
+
+class StreamingAggregator:
+    '''
+    Incremental equivalent of aggregates.aggregate()
+    Input: Bands used as the zones dimension (None to skip the zones table) and the
+           relative error of the monthly patients count (None: exact; otherwise
+           the distinct patients are counted with HyperLogLog sketches)
+    Example: aggregator = StreamingAggregator()
+             for chunk in iter_chunks('phq_all_final.csv'): aggregator.update(chunk)
+             report = aggregator.report()
+    '''
+
+    def __init__(self, bands=GAD7_ZONES, distinct_error=None):
+        self.bands = bands
+        self.rows = 0
+        # Counts indexed by day/month number since January 1970
+        self.daily = np.zeros(0, dtype=np.int64)
+        self.monthly = np.zeros(0, dtype=np.int64)
+        n_labels = len(bands.labels) if bands is not None else 0
+        self.zones = np.zeros((0, n_labels), dtype=np.int64)
+        self.patients = pd.Series(dtype=np.int64)
+        self.patient_dtype = None
+        # Distinct (month, patient) keys: one compacted array plus the unique keys of recent chunks
+        self._month_patients = np.zeros(0, dtype=np.int64)
+        self._pending = []
+        self._pending_size = 0
+        self.sketches = DailySketches(error=distinct_error) if distinct_error is not None else None
+
+    def update(self, chunk):
+        '''
+        Input: typed assessments dataframe
+        Output: the aggregator, with the chunk folded in
+        '''
+        if len(chunk) == 0:
+            return self
+        dates = np.asarray(chunk['date'].values, dtype='datetime64[ns]')
+        days = dates.astype('datetime64[D]').astype(np.int64)
+        months = month_index(dates)
+        if days.min() < 0:
+            raise ValueError("Assessments dated before 1970 are not supported")
+        patient_ids = chunk['patient_id'].values
+        if self.patient_dtype is None:
+            self.patient_dtype = patient_ids.dtype
+
+        self.rows += len(chunk)
+        self.daily = _add_counts(self.daily, np.bincount(days))
+        self.monthly = _add_counts(self.monthly, np.bincount(months))
+        self.patients = self.patients.add(pd.Series(patient_ids).value_counts(sort=False), fill_value=0)
+
+        if self.sketches is not None:
+            self.sketches.update(chunk)
+        else:
+            keys = pd.unique(months * (1 << 32) + (patient_ids.astype(np.int64) & 0xFFFFFFFF))
+            self._pending.append(keys)
+            self._pending_size += len(keys)
+            if self._pending_size > max(len(self._month_patients), 1_000_000):
+                self._compact()
+
+        if self.bands is not None:
+            codes = self.bands.cut(chunk['score'].values).codes
+            known = codes >= 0
+            n_labels = len(self.bands.labels)
+            counts = np.bincount(
+                months[known] * n_labels + codes[known], minlength=(months.max() + 1) * n_labels
+                ).reshape(-1, n_labels)
+            self.zones = _add_counts(self.zones, counts)
+        return self
+
+    def merge(self, other):
+        '''
+        Input: StreamingAggregator of other rows (e.g. another partition), same bands
+        Output: the aggregator, with the other one's counts folded in
+        '''
+        if (other.bands is None) != (self.bands is None) or (other.sketches is None) != (self.sketches is None):
+            raise ValueError("Cannot merge aggregators with different zones or distinct counting")
+        self.rows += other.rows
+        self.daily = _add_counts(self.daily, other.daily.copy())
+        self.monthly = _add_counts(self.monthly, other.monthly.copy())
+        self.zones = _add_counts(self.zones, other.zones.copy())
+        self.patients = self.patients.add(other.patients, fill_value=0)
+        if self.patient_dtype is None:
+            self.patient_dtype = other.patient_dtype
+        if self.sketches is not None:
+            self.sketches.merge(other.sketches)
+        for keys in [other._month_patients] + other._pending:
+            self._pending.append(keys)
+            self._pending_size += len(keys)
+        return self
+
+    def _compact(self):
+        self._month_patients = pd.unique(np.concatenate([self._month_patients] + self._pending))
+        self._pending = []
+        self._pending_size = 0
+
+    def report(self):
+        '''
+        Output: Report with the same tables as aggregates.aggregate() on all the rows seen so far
+        '''
+        self._compact()
+        observed_days = np.flatnonzero(self.daily)
+        daily = pd.DataFrame({
+            'date': observed_days.astype('datetime64[D]'),
+            'Assessments Count': self.daily[observed_days],
+            })
+
+        observed_months = np.flatnonzero(self.monthly)
+        # Calendar columns built the same way as for the in-memory frame
+        month_starts = observed_months.astype('datetime64[M]').astype('datetime64[ns]')
+        calendar = add_calendar(pd.DataFrame({'date': month_starts}))
+        first = observed_months[0] if len(observed_months) else 0
+        if self.sketches is not None:
+            estimates = self.sketches.monthly()
+            month_patients = np.zeros(len(self.monthly), dtype=np.int64)
+            # Period ordinals are months since January 1970, like the monthly count index
+            month_patients[estimates.index.asi8] = estimates.values
+        else:
+            month_patients = np.bincount(self._month_patients >> 32, minlength=len(self.monthly))
+        monthly = calendar_frame(calendar, observed_months - first)
+        monthly['Assessments Count'] = self.monthly[observed_months]
+        monthly['Patients Count'] = month_patients[observed_months]
+
+        patients = pd.DataFrame({
+            'patient_id': self.patients.index.values.astype(
+                self.patient_dtype if self.patient_dtype is not None else np.int64
+                ),
+            'times_taken': self.patients.values.astype(np.int64),
+            })
+        patients = patients.sort_values(['times_taken', 'patient_id'], ascending=[False, True], kind='stable')
+        patients.reset_index(drop=True, inplace=True)
+
+        zones = None
+        if self.bands is not None:
+            month_idx, value_idx = np.nonzero(self.zones)
+            zones = calendar_frame(calendar, month_idx - first)
+            zones[self.bands.name] = pd.Categorical.from_codes(value_idx, dtype=self.bands.dtype)
+            zones['Zones Count'] = self.zones[month_idx, value_idx]
+
+        return Report(daily, monthly, patients, zones)
+
+
+def aggregate_stream(source, chunksize=1_000_000, bands=GAD7_ZONES, distinct_error=None):
+    '''
+    Input: CSV export or directory of partitions, rows per chunk, the zones Bands
+           and the relative error of the monthly patients count (None: exact)
+    Output: Report computed with bounded memory
+    '''
+    aggregator = StreamingAggregator(bands, distinct_error)
+    for chunk in iter_chunks(source, chunksize):
+        aggregator.update(chunk)
+    return aggregator.report()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Synthetic GAD-7 assessments shaped like phq_all_final.csv
+
+*   Test-taking frequency is heavily skewed: patient weights follow a Pareto
+    distribution, so most patients take the assessment once or twice and a few take
+    it hundreds of times (about 25% of the patients take it only once at the
+    default density).
+*   Patients join between June 2019 and July 2020, more of them in 2020, and stay
+    active for about three months; every assessment is dated after the patient was
+    created.
+*   Scores run from 0 to 21: each patient has a baseline drawn from a right-skewed
+    distribution (most results in the 'safe zone', roughly 25% at 10 or above) and
+    each assessment varies around it.
+
+Usage: python synthetic.py ROWS OUT_PATH [--seed N]
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from loader import COLUMNS
+
+
+START = pd.Timestamp('2019-06-01')
+END = pd.Timestamp('2020-08-01')
+
+
+def generate_assessments(rows, seed=0, rows_per_patient=7):
+    '''
+    Input: number of assessments, random seed and the average number of
+           assessments per patient
+    Output: typed assessments dataframe (same dtypes as loader.load_assessments)
+            sorted by date
+    '''
+    rng = np.random.default_rng(seed)
+    n_patients = max(rows // rows_per_patient, 1)
+    span = (END - START).value
+
+    # Skewed test-taking frequency: every patient takes at least one assessment
+    weights = rng.pareto(1.5, n_patients) + 0.02
+    patient_codes = np.concatenate([
+        np.arange(min(n_patients, rows)),
+        rng.choice(n_patients, size=max(rows - n_patients, 0), p=weights / weights.sum()),
+        ])
+    patient_ids = rng.permutation(n_patients * 2)[:n_patients].astype(np.int32) + 1
+
+    # Patients join over the period, more of them later
+    day = 86_400_000_000_000
+    created = START.value + (rng.random(n_patients) ** 0.8 * 0.95 * span).astype(np.int64)
+    created = (created // day) * day
+    # Each patient stays active for a while (about 3 months on average) after joining
+    active = np.minimum(rng.exponential(90 * day, n_patients), END.value - created)
+    dates = created[patient_codes] + (rng.random(rows) * active[patient_codes]).astype(np.int64)
+    dates = (dates // 1000) * 1000
+
+    # Right-skewed baseline per patient, noise per assessment
+    baseline = np.clip(rng.gamma(2.0, 3.3, n_patients), 0, 21)
+    scores = np.clip(np.rint(baseline[patient_codes] + rng.normal(0, 2.5, rows)), 0, 21)
+
+    order = np.argsort(dates, kind='stable')
+    df = pd.DataFrame({
+        'date': dates[order].astype('datetime64[ns]'),
+        'patient_id': patient_ids[patient_codes[order]],
+        'type': pd.Categorical(np.repeat('gad7', rows)),
+        'patient_date_created': created[patient_codes[order]].astype('datetime64[ns]'),
+        'score': scores[order].astype(np.uint8),
+        })
+    return df[COLUMNS]
+
+
+def write_csv(df, path):
+    '''
+    Input: typed assessments dataframe and output path
+    Output: None, the frame is written in the raw export format
+    Example: 2019-08-26 13:32:43.019162 -> 2019-08-26T13:32:43.019162
+    '''
+    raw = df.copy()
+    for column in ['date', 'patient_date_created']:
+        raw[column] = raw[column].dt.strftime('%Y-%m-%dT%H:%M:%S.%f')
+    raw.to_csv(path, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('rows', type=int)
+    parser.add_argument('out_path')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_csv(generate_assessments(args.rows, args.seed), args.out_path)
+
+
+if __name__ == '__main__':
+    main()
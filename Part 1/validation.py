@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Data-quality checks of the assessments
+
+Every check is a vectorized mask over the whole frame, computed once:
+
+*   duplicate: the row repeats an earlier one (the first copy is kept),
+*   null: the row has a missing value,
+*   invalid_patient_id: the patient id is not a whole number that fits int32,
+*   score_out_of_range: the score is not a whole number in 0-21,
+*   unknown_type: the assessment is not one of the expected types (GAD-7),
+*   before_creation: the assessment is dated before the patient was created.
+
+validate() returns the clean rows, the failing rows set aside in a quarantine
+frame (with an 'issues' column naming the checks they failed and their original
+row labels as index) and a summary of the counts and null rates per column. The
+clean rows are narrowed to the loader's SCHEMA dtypes.
+
+The checks have to see the values as written. read_checked() parses the export
+once, with the loader's wide RAW_SCHEMA: when every value fits SCHEMA the frame is
+narrowed and cached as the loader's own cache, otherwise the frame as read is
+cached next to it, with missing and out-of-range values kept for validate() to
+quarantine. Either way later runs read the cache instead of the CSV. Values that do
+not parse at all (an id of 'abc', a date of 'notadate') are nulls in the frame, and
+their text is kept in df.attrs['as_written'], so the quarantine shows them as written.
+
+Usage: python validation.py DATA_PATH [--quarantine quarantine.csv]
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from banding import GAD7_ZONES
+from loader import (
+    COLUMNS, DATE_COLUMNS, RAW_SCHEMA, SCHEMA, SchemaError, cache_path, narrow_types, parse_timestamps, pyarrow,
+    write_cache,
+    )
+
+
+EXPECTED_TYPES = ['gad7']
+
+# Checks in the order they are listed in the summary and the 'issues' column
+CHECKS = ['duplicate', 'null', 'invalid_patient_id', 'score_out_of_range', 'unknown_type', 'before_creation']
+
+
+def check_rows(df, types=EXPECTED_TYPES, max_score=GAD7_ZONES.max_score):
+    '''
+    Input: assessments dataframe (typed or as read from the CSV), expected
+           assessment types and maximum valid score
+    Output: dict of check name -> boolean array, True where the row fails the check
+    '''
+    score = pd.to_numeric(df['score'], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    patient_id = pd.to_numeric(df['patient_id'], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    nulls = df[COLUMNS].isna().values.any(axis=1) | np.isnan(score) | np.isnan(patient_id)
+    types_present = df['type'].notna().values
+    id_limits = np.iinfo(SCHEMA['patient_id'])
+    # NaN fails every comparison: a missing id or score is only a null
+    valid_id = (patient_id >= id_limits.min) & (patient_id <= id_limits.max) & (patient_id == np.floor(patient_id))
+    valid_score = (score >= 0) & (score <= max_score) & (score == np.floor(score))
+    return {
+        'duplicate': df.duplicated(subset=COLUMNS, keep='first').values,
+        'null': nulls,
+        'invalid_patient_id': ~valid_id & ~np.isnan(patient_id),
+        'score_out_of_range': ~valid_score & ~np.isnan(score),
+        'unknown_type': types_present & ~df['type'].isin(types).values,
+        'before_creation': (df['date'] < df['patient_date_created']).values,
+    }
+
+
+def validate(df, types=EXPECTED_TYPES, max_score=GAD7_ZONES.max_score):
+    '''
+    Input: assessments dataframe (see read_checked), expected assessment types and
+           maximum valid score
+    Output: (clean rows with the SCHEMA dtypes, quarantined rows with an 'issues'
+            column, summary dict)
+    Example: df, quarantine, summary = validate(df)
+             summary -> {'rows': 53698, 'duplicate': 0, ..., 'quarantined': 0, 'null_rates': {...}}
+    '''
+    masks = check_rows(df, types, max_score)
+    bad = np.zeros(len(df), dtype=bool)
+    for mask in masks.values():
+        bad |= mask
+
+    summary = {'rows': len(df)}
+    summary.update({name: int(masks[name].sum()) for name in CHECKS})
+    summary['quarantined'] = int(bad.sum())
+    summary['null_rates'] = {column: float(rate) for column, rate in df[COLUMNS].isna().mean().items()}
+
+    quarantine = df.loc[bad].copy()
+    issues = np.full(len(quarantine), '', dtype=object)
+    for name in CHECKS:
+        failed = masks[name][bad]
+        issues[failed] = issues[failed] + name + ','
+    quarantine['issues'] = pd.Series(issues, index=quarantine.index).str.rstrip(',')
+    for column in ['patient_id', 'score']:
+        values = quarantine[column]
+        if values.dtype.kind == 'f' and (values.dropna() % 1 == 0).all():
+            # Whole numbers are written back as such: 300, not 300.0
+            quarantine[column] = values.astype('Int64')
+    for column, cells in quarantine.attrs.pop('as_written', {}).items():
+        rows, texts = zip(*cells)
+        quarantine[column] = quarantine[column].astype(object)
+        quarantine.loc[list(rows), column] = list(texts)
+    if bad.any():
+        clean = df.loc[~bad].reset_index(drop=True)
+        clean.attrs.pop('as_written', None)
+        clean['type'] = clean['type'].astype('category').cat.remove_unused_categories()
+    else:
+        # Nothing to drop: the frame is returned as is, without a copy
+        clean = df
+    # Every value left fits: a frame read untyped is narrowed like the loader's
+    return narrow_types(clean), quarantine, summary
+
+
+def format_summary(summary):
+    '''
+    Input: summary dict from validate()
+    Output: short text report
+    '''
+    rows = summary['rows']
+    lines = [f"{rows:,} rows, {summary['quarantined']:,} quarantined ({summary['quarantined'] / max(rows, 1):.2%})"]
+    lines += [f"  {name:<20} {summary[name]:>10,}" for name in CHECKS]
+    rates = ', '.join(f"{column} {rate * 100:.2g}%" for column, rate in summary['null_rates'].items())
+    lines.append(f"  null rates: {rates}")
+    return '\n'.join(lines)
+
+
+def read_untyped(path):
+    '''
+    Input: path to the raw CSV export
+    Output: dataframe with the RAW_SCHEMA dtypes (ids and scores as float64) and
+            datetime64 dates; values that do not parse are nulls, and their text is
+            kept in df.attrs['as_written'] ({column: [[row, text], ...]})
+    '''
+    try:
+        df = pd.read_csv(path, usecols=COLUMNS, dtype=RAW_SCHEMA)[COLUMNS]
+    except ValueError:
+        # Text in a numeric column (e.g. an id of 'abc'): read the columns as written
+        df = pd.read_csv(path, usecols=COLUMNS, dtype=dict(RAW_SCHEMA, patient_id=str, score=str))[COLUMNS]
+    as_written = {}
+    for column in ['patient_id', 'score'] + DATE_COLUMNS:
+        values = df[column]
+        if column in DATE_COLUMNS:
+            try:
+                parsed = parse_timestamps(values)
+            except ValueError:
+                parsed = pd.to_datetime(values, format='ISO8601', errors='coerce').dt.as_unit('us')
+        elif values.dtype.kind == 'f':
+            continue
+        else:
+            parsed = pd.Series(
+                pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan), index=values.index
+                )
+        unparsed = parsed.isna().values & values.notna().values
+        if unparsed.any():
+            as_written[column] = [[int(row), str(text)] for row, text in values[unparsed].items()]
+        df[column] = parsed
+    if as_written:
+        df.attrs['as_written'] = as_written
+    return df
+
+
+def read_checked(path, cache=True, cache_dir=None):
+    '''
+    Input: path to the raw CSV export and the loader's cache options
+    Output: the loader's typed frame when every value fits SCHEMA, otherwise the
+            frame as read (read_untyped), for validate()
+    Example: validate(read_checked('phq_all_final.csv')) parses the CSV on the first run only
+    '''
+    cached = cache and pyarrow is not None
+    if cached:
+        typed, untyped = cache_path(path, cache_dir), cache_path(path, cache_dir, tag='unchecked')
+        for target in (typed, untyped):
+            if os.path.exists(target):
+                return pd.read_parquet(target)
+    df = read_untyped(path)
+    try:
+        df = narrow_types(df)
+        target = typed if cached else None
+    except SchemaError:
+        # Kept as read: validate() quarantines what does not fit
+        target = untyped if cached else None
+    if target:
+        write_cache(df, path, target, cache_dir)
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('data_path')
+    parser.add_argument('--quarantine', help="write the quarantined rows to this CSV file")
+    parser.add_argument('--json', action='store_true', help="print the summary as JSON")
+    args = parser.parse_args()
+
+    _, quarantine, summary = validate(read_checked(args.data_path))
+    print(json.dumps(summary, indent=2) if args.json else format_summary(summary))
+    if args.quarantine:
+        quarantine.to_csv(args.quarantine, index_label='row')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""30-day exercise completion rate per monthly sign-up cohort (Q1), without a join
+
+The users are sorted by user_id once; every exercise row then finds its user's
+sign-up time with a binary search on that sorted array, so the users x exercises
+join is never materialized. A user counts as completed when any of their exercises
+was finished within 30 days of creating their account, which is a bincount over the
+qualifying rows. Exercises can be fed in chunks (CSV chunks or Parquet row groups),
+so the exercises table never has to fit in memory: only one flag per user is kept.
+
+Usage: python completion_rate.py DATA_DIR [--days 30] [--chunksize 5000000]
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from sql_runner import table_path
+
+
+class CompletionRate:
+    '''
+    Running 30-day completion flags for a users table
+    Input: users dataframe ('user_id', 'created_at') and the completion window in days
+    Example: rate = CompletionRate(users)
+             for chunk in exercise_chunks: rate.update(chunk)
+             rate.cohorts()
+    '''
+
+    def __init__(self, users, days=30):
+        order = np.argsort(users['user_id'].values, kind='stable')
+        self.user_ids = users['user_id'].values[order]
+        if len(self.user_ids) > 1 and (self.user_ids[1:] == self.user_ids[:-1]).any():
+            raise ValueError("users.user_id is not unique")
+        self.created_at = pd.to_datetime(users['created_at']).values[order].astype('datetime64[ns]')
+        self.window = np.timedelta64(days, 'D')
+        self.completed = np.zeros(len(self.user_ids), dtype=bool)
+
+    def update(self, exercises):
+        '''
+        Input: exercises dataframe ('user_id', 'exercise_completion_date'), any order
+        Output: the CompletionRate, with the chunk's completions folded in
+        '''
+        user_ids = exercises['user_id'].values
+        pos = np.searchsorted(self.user_ids, user_ids)
+        known = pos < len(self.user_ids)
+        known[known] = self.user_ids[pos[known]] == user_ids[known]
+        pos = pos[known]
+        completion = pd.to_datetime(exercises['exercise_completion_date']).values[known].astype('datetime64[ns]')
+        delay = completion - self.created_at[pos]
+        in_window = (delay >= np.timedelta64(0, 'ns')) & (delay <= self.window)
+        self.completed[pos[in_window]] = True
+        return self
+
+    def cohorts(self):
+        '''
+        Output: dataframe with one row per monthly sign-up cohort: 'date_time'
+                ('month,year' as in the SQL), 'users', 'completed' and 'completion_rate'
+        '''
+        months = self.created_at.astype('datetime64[M]').astype(np.int64)
+        first = int(months.min()) if len(months) else 0
+        codes = months - first
+        users = np.bincount(codes)
+        completed = np.bincount(codes, weights=self.completed, minlength=len(users)).astype(np.int64)
+        observed = np.flatnonzero(users)
+        cohort = (observed + first).astype('datetime64[M]')
+        years = cohort.astype('datetime64[Y]').astype(np.int64) + 1970
+        month_numbers = (observed + first) % 12 + 1
+        return pd.DataFrame({
+            'date_time': [f"{month},{year}" for month, year in zip(month_numbers, years)],
+            'cohort': pd.PeriodIndex(cohort, freq='M'),
+            'users': users[observed],
+            'completed': completed[observed],
+            'completion_rate': completed[observed] / users[observed],
+            })
+
+
+def completion_rates(users, exercises, days=30):
+    '''
+    Input: users and exercises dataframes, completion window in days
+    Output: completion rate per monthly sign-up cohort (see CompletionRate.cohorts)
+    '''
+    return CompletionRate(users, days).update(exercises).cohorts()
+
+
+def iter_exercises(path, chunksize=5_000_000):
+    '''
+    Input: path to the exercises CSV or Parquet file and the rows per chunk
+    Output: iterator of dataframes with 'user_id' and 'exercise_completion_date'
+    '''
+    columns = ['user_id', 'exercise_completion_date']
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+        return
+    with pd.read_csv(path, usecols=columns, chunksize=chunksize) as reader:
+        yield from reader
+
+
+def completion_rates_from_files(data_dir, days=30, chunksize=5_000_000):
+    '''
+    Input: directory holding users and exercises (CSV or Parquet), completion
+           window in days and exercise rows per chunk
+    Output: completion rate per monthly sign-up cohort
+    '''
+    users_path = table_path(data_dir, 'users')
+    if users_path.endswith('.parquet'):
+        users = pd.read_parquet(users_path, columns=['user_id', 'created_at'])
+    else:
+        users = pd.read_csv(users_path, usecols=['user_id', 'created_at'])
+    rate = CompletionRate(users, days)
+    for chunk in iter_exercises(table_path(data_dir, 'exercises'), chunksize):
+        rate.update(chunk)
+    return rate.cohorts()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('data_dir')
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--chunksize', type=int, default=5_000_000)
+    args = parser.parse_args()
+    if not os.path.isdir(args.data_dir):
+        parser.error(f"{args.data_dir} is not a directory")
+    print(completion_rates_from_files(args.data_dir, args.days, args.chunksize).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
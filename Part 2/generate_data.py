@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Synthetic tables for the Part 2 queries
+
+Writes users, exercises, exercise_2 and Phq9 as CSV (or Parquet) files into a data
+directory, with the columns the queries use:
+
+*   users: user_id, created_at
+*   exercises: exercise_id, user_id, exercise_completion_date
+*   exercise_2: exercise_id, user_id
+*   Phq9: patient_id, provider_id, score, date_taken
+
+About 60% of the users complete an exercise, most of them within their first month.
+
+Usage: python generate_data.py USERS DATA_DIR [--format parquet] [--seed N]
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+
+START = pd.Timestamp('2019-01-01')
+END = pd.Timestamp('2020-08-01')
+SECOND = 1_000_000_000
+DAY = 86_400 * SECOND
+
+TABLES = ['users', 'exercises', 'exercise_2', 'Phq9']
+
+
+def generate_tables(users, seed=0, exercises_per_user=3, providers=None):
+    '''
+    Input: number of users, random seed, average number of exercises per
+           completing user and number of providers (default: one per 200 users)
+    Output: dict of table name -> dataframe
+    '''
+    rng = np.random.default_rng(seed)
+    user_ids = np.arange(1, users + 1, dtype=np.int64)
+    created = START.value + rng.integers(0, END.value - START.value, users)
+    created = (created // SECOND) * SECOND
+
+    # Completing users do a skewed number of exercises, starting a few days after sign-up
+    completing = rng.random(users) < 0.6
+    counts = np.where(completing, rng.geometric(1 / exercises_per_user, users), 0)
+    owner = np.repeat(np.arange(users), counts)
+    delay = rng.exponential(20 * DAY, len(owner)).astype(np.int64)
+    completion = np.minimum(created[owner] + delay, END.value)
+    completion = (completion // SECOND) * SECOND
+
+    # Activities: each user picks a few distinct exercise ids out of a catalog of 50
+    activity_counts = rng.geometric(0.4, users)
+    activity_owner = np.repeat(user_ids, activity_counts)
+    activities = rng.integers(1, 51, len(activity_owner))
+
+    # PHQ-9 results: every provider has its own score level
+    providers = providers or max(users // 200, 5)
+    provider_level = rng.gamma(2.0, 3.5, providers)
+    phq_patients = rng.choice(user_ids, size=users)
+    phq_provider = rng.integers(1, providers + 1, users)
+    phq_scores = np.clip(np.rint(provider_level[phq_provider - 1] + rng.normal(0, 4, users)), 0, 27)
+
+    return {
+        'users': pd.DataFrame({'user_id': user_ids, 'created_at': created.astype('datetime64[ns]')}),
+        'exercises': pd.DataFrame({
+            'exercise_id': np.arange(1, len(owner) + 1, dtype=np.int64),
+            'user_id': user_ids[owner],
+            'exercise_completion_date': completion.astype('datetime64[ns]'),
+            }),
+        'exercise_2': pd.DataFrame({'exercise_id': activities, 'user_id': activity_owner}),
+        'Phq9': pd.DataFrame({
+            'patient_id': phq_patients,
+            'provider_id': phq_provider,
+            'score': phq_scores.astype(np.int64),
+            'date_taken': (START.value + rng.integers(0, END.value - START.value, users)).astype('datetime64[ns]'),
+            }),
+    }
+
+
+def write_tables(tables, data_dir, fmt='csv'):
+    '''
+    Input: dict of tables, output directory and file format ('csv' or 'parquet')
+    Output: list of written paths
+    '''
+    os.makedirs(data_dir, exist_ok=True)
+    paths = []
+    for name, table in tables.items():
+        path = os.path.join(data_dir, f"{name}.{fmt}")
+        if fmt == 'parquet':
+            table.to_parquet(path, index=False)
+        else:
+            table.to_csv(path, index=False, date_format='%Y-%m-%d %H:%M:%S')
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('users', type=int)
+    parser.add_argument('data_dir')
+    parser.add_argument('--format', default='csv', choices=['csv', 'parquet'])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for path in write_tables(generate_tables(args.users, args.seed), args.data_dir, args.format):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Running PHQ-9 statistics per provider and the Q3 leaderboard
+
+The score sum and the number of results of every provider are kept in two arrays
+aligned with a sorted array of the provider ids seen so far (so their size follows
+the number of providers, not the largest id) and updated with a bincount per batch
+of new Phq9 rows, so the ranking never rescans the table. Like SQL's AVG, missing
+scores are left out of both the average and the results count. The top k providers by average score are
+selected with np.argpartition over the providers with enough results, then sorted
+like the SQL (average score descending, provider_id ascending); the last
+leaderboard is cached until the next update.
+
+Usage: python provider_stats.py DATA_DIR [--top 5] [--min-results 1] [--chunksize 5000000]
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from sql_runner import table_path
+
+
+class ProviderStats:
+    '''
+    Running score sum and result count per provider
+    Example: stats = ProviderStats()
+             for chunk in phq9_chunks: stats.update(chunk)
+             stats.top(5, min_results=30)
+    '''
+
+    def __init__(self):
+        self.provider_ids = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros(0, dtype=np.float64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self._leaderboards = {}
+
+    def update(self, phq9):
+        '''
+        Input: dataframe of new Phq9 rows ('provider_id', 'score'); rows with a
+               missing score or provider are skipped
+        Output: the ProviderStats, with the rows folded in
+        '''
+        scores = phq9['score'].to_numpy(dtype=np.float64, na_value=np.nan)
+        providers = phq9['provider_id'].to_numpy(dtype=np.float64, na_value=np.nan)
+        present = ~np.isnan(scores) & ~np.isnan(providers)
+        if not present.any():
+            return self
+        batch_ids, codes = np.unique(providers[present].astype(np.int64), return_inverse=True)
+        batch_sums = np.bincount(codes, weights=scores[present], minlength=len(batch_ids))
+        batch_counts = np.bincount(codes, minlength=len(batch_ids))
+
+        provider_ids = np.union1d(self.provider_ids, batch_ids)
+        sums = np.zeros(len(provider_ids), dtype=np.float64)
+        counts = np.zeros(len(provider_ids), dtype=np.int64)
+        known = np.searchsorted(provider_ids, self.provider_ids)
+        sums[known] = self.sums
+        counts[known] = self.counts
+        new = np.searchsorted(provider_ids, batch_ids)
+        sums[new] += batch_sums
+        counts[new] += batch_counts
+        self.provider_ids, self.sums, self.counts = provider_ids, sums, counts
+        self._leaderboards.clear()
+        return self
+
+    def averages(self, min_results=1):
+        '''
+        Input: minimum number of results a provider needs
+        Output: dataframe of 'provider_id', 'results' and 'avg_score' for those providers
+        '''
+        positions = np.flatnonzero(self.counts >= max(min_results, 1))
+        return pd.DataFrame({
+            'provider_id': self.provider_ids[positions],
+            'results': self.counts[positions],
+            'avg_score': self.sums[positions] / self.counts[positions],
+            })
+
+    def top(self, k=5, min_results=1):
+        '''
+        Input: number of providers and the minimum number of results a provider needs
+        Output: dataframe of the k providers with the highest average score
+                ('provider_id', 'results', 'avg_score'), same order as Q3
+        '''
+        key = (k, min_results)
+        if key not in self._leaderboards:
+            positions = np.flatnonzero(self.counts >= max(min_results, 1))
+            averages = self.sums[positions] / self.counts[positions]
+            if 0 < k < len(positions):
+                # Keep every provider tied with the k-th average, the sort below breaks the tie
+                kth = np.partition(averages, len(averages) - k)[len(averages) - k]
+                candidates = averages >= kth
+                positions, averages = positions[candidates], averages[candidates]
+            order = np.lexsort((self.provider_ids[positions], -averages))[:max(k, 0)]
+            self._leaderboards[key] = pd.DataFrame({
+                'provider_id': self.provider_ids[positions[order]],
+                'results': self.counts[positions[order]],
+                'avg_score': averages[order],
+                })
+        return self._leaderboards[key]
+
+
+def provider_stats_from_files(data_dir, chunksize=5_000_000):
+    '''
+    Input: directory holding Phq9.csv or Phq9.parquet and the rows per chunk
+    Output: ProviderStats of the whole table
+    '''
+    columns = ['provider_id', 'score']
+    path = table_path(data_dir, 'Phq9')
+    stats = ProviderStats()
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            stats.update(batch.to_pandas())
+        return stats
+    with pd.read_csv(path, usecols=columns, chunksize=chunksize) as reader:
+        for chunk in reader:
+            stats.update(chunk)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('data_dir')
+    parser.add_argument('--top', type=int, default=5)
+    parser.add_argument('--min-results', type=int, default=1)
+    parser.add_argument('--chunksize', type=int, default=5_000_000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    stats = provider_stats_from_files(args.data_dir, args.chunksize)
+    print(f"{len(stats.averages()):,} providers loaded in {time.perf_counter() - start:.3f}s")
+    start = time.perf_counter()
+    leaderboard = stats.top(args.top, args.min_results)
+    print(f"top {args.top} in {(time.perf_counter() - start) * 1e6:.0f}us")
+    print(leaderboard.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
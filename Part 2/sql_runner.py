@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""Run the Part 2 queries locally on an embedded engine
+
+The users, exercises, exercise_2 and Phq9 tables are loaded from CSV or Parquet
+files (<DATA_DIR>/<table>.csv|.parquet, see generate_data.py) into DuckDB, or into
+SQLite when DuckDB is not installed, indexed on their join/grouping keys, and each
+query is timed.
+
+neuroflow_take_home_project_part2.sql is MySQL, so the runner keeps portable
+versions of the queries for each engine. They also fix what the MySQL versions get
+wrong:
+
+*   Q1 divided two counts taken from the same already-filtered subquery, which is
+    always 1. Here the rate is the share of each monthly sign-up cohort that
+    completed an exercise within 30 days of creating their account.
+*   Q2 had its two columns swapped: it now gives, for each number of distinct
+    activities, the number of users who did that many.
+*   Q3 averaged the whole table (no GROUP BY provider_id). It now ranks the top 5
+    providers by average PHQ-9 score.
+
+Usage: python sql_runner.py DATA_DIR [--engine duckdb|sqlite] [--repeat 3] [--show]
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+
+TABLES = ['users', 'exercises', 'exercise_2', 'Phq9']
+
+# (table, column) pairs indexed after loading
+INDEXES = [
+    ('users', 'user_id'),
+    ('exercises', 'user_id'),
+    ('exercise_2', 'user_id'),
+    ('Phq9', 'provider_id'),
+]
+
+QUERIES = {
+    'Q1': {
+        'duckdb': '''
+            select extract(month from u.created_at) || ',' || extract(year from u.created_at) as date_time,
+                   avg(case when c.user_id is null then 0.0 else 1.0 end) as completion_rate
+            from users u
+            left join (
+                select distinct e.user_id
+                from exercises e join users u on u.user_id = e.user_id
+                where e.exercise_completion_date between u.created_at and u.created_at + interval 30 day
+            ) c on c.user_id = u.user_id
+            group by extract(year from u.created_at), extract(month from u.created_at)
+            order by extract(year from u.created_at), extract(month from u.created_at)
+            ''',
+        'sqlite': '''
+            select cast(strftime('%m', u.created_at) as integer) || ',' || strftime('%Y', u.created_at) as date_time,
+                   avg(case when c.user_id is null then 0.0 else 1.0 end) as completion_rate
+            from users u
+            left join (
+                select distinct e.user_id
+                from exercises e join users u on u.user_id = e.user_id
+                where julianday(e.exercise_completion_date) - julianday(u.created_at) between 0 and 30
+            ) c on c.user_id = u.user_id
+            group by strftime('%Y-%m', u.created_at)
+            order by strftime('%Y-%m', u.created_at)
+            ''',
+    },
+    'Q2': '''
+        select nums_exer as "Number of activities", count(*) as "Number of users"
+        from (
+            select user_id, count(distinct exercise_id) as nums_exer
+            from exercise_2
+            group by user_id
+        ) as total
+        group by nums_exer
+        order by nums_exer
+        ''',
+    'Q3': '''
+        select provider_id, avg(score) as avg_score
+        from Phq9
+        group by provider_id
+        order by avg_score desc, provider_id
+        limit 5
+        ''',
+}
+
+
+def query_text(name, engine):
+    '''
+    Input: query name ('Q1', 'Q2', 'Q3') and engine name
+    Output: SQL of the query for the engine
+    '''
+    query = QUERIES[name]
+    if isinstance(query, dict):
+        query = query[engine]
+    return query
+
+
+def table_path(data_dir, table):
+    '''
+    Input: data directory and table name
+    Output: path of the table's Parquet or CSV file
+    '''
+    for ext in ['parquet', 'csv']:
+        path = os.path.join(data_dir, f"{table}.{ext}")
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"No {table}.parquet or {table}.csv in {data_dir}")
+
+
+class SqlRunner:
+    '''
+    Embedded database holding the Part 2 tables
+    Input: engine ('duckdb' or 'sqlite', default: duckdb when installed) and
+           database path (default: in memory)
+    '''
+
+    def __init__(self, engine=None, database=':memory:'):
+        engine = engine or ('duckdb' if duckdb is not None else 'sqlite')
+        if engine == 'duckdb':
+            if duckdb is None:
+                raise ImportError("duckdb is not installed, use engine='sqlite'")
+            self.connection = duckdb.connect(database)
+        elif engine == 'sqlite':
+            self.connection = sqlite3.connect(database)
+        else:
+            raise ValueError(f"Unknown engine: {engine!r}, expected 'duckdb' or 'sqlite'")
+        self.engine = engine
+
+    def _load_table(self, table, path):
+        if self.engine == 'duckdb':
+            reader = 'read_parquet' if path.endswith('.parquet') else 'read_csv_auto'
+            self.connection.execute(f"create or replace table {table} as select * from {reader}(?)", [path])
+            return
+        self.connection.execute(f"drop table if exists {table}")
+        if path.endswith('.parquet'):
+            pd.read_parquet(path).to_sql(table, self.connection, index=False, chunksize=100_000)
+            return
+        for chunk in pd.read_csv(path, chunksize=1_000_000):
+            chunk.to_sql(table, self.connection, index=False, if_exists='append', chunksize=100_000)
+
+    def load(self, data_dir, tables=TABLES):
+        '''
+        Input: data directory and the tables to load
+        Output: dict of table name -> (rows, seconds to load and index)
+        '''
+        timings = {}
+        for table in tables:
+            start = time.perf_counter()
+            self._load_table(table, table_path(data_dir, table))
+            for indexed_table, column in INDEXES:
+                if indexed_table == table:
+                    self.connection.execute(f"create index idx_{table}_{column} on {table} ({column})")
+            rows = self.connection.execute(f"select count(*) from {table}").fetchone()[0]
+            timings[table] = (rows, time.perf_counter() - start)
+        if self.engine == 'sqlite':
+            self.connection.execute("analyze")
+        return timings
+
+    def query(self, sql):
+        '''
+        Input: SQL text
+        Output: result dataframe
+        '''
+        if self.engine == 'duckdb':
+            return self.connection.execute(sql).df()
+        return pd.read_sql_query(sql, self.connection)
+
+    def run(self, name, repeat=1):
+        '''
+        Input: query name and number of runs
+        Output: (result dataframe, best wall time in seconds)
+        '''
+        sql = query_text(name, self.engine)
+        best, result = float('inf'), None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = self.query(sql)
+            best = min(best, time.perf_counter() - start)
+        return result, best
+
+    def run_all(self, repeat=1):
+        '''
+        Input: number of runs per query
+        Output: dict of query name -> (result dataframe, best wall time in seconds)
+        '''
+        return {name: self.run(name, repeat) for name in QUERIES}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('data_dir')
+    parser.add_argument('--engine', choices=['duckdb', 'sqlite'], default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--show', action='store_true', help="print the query results")
+    args = parser.parse_args()
+
+    runner = SqlRunner(args.engine)
+    print(f"engine: {runner.engine}")
+    for table, (rows, seconds) in runner.load(args.data_dir).items():
+        print(f"  load {table:<12} {rows:>12,} rows {seconds:>9.3f}s")
+    for name, (result, seconds) in runner.run_all(args.repeat).items():
+        print(f"  {name:<17} {len(result):>12,} rows {seconds:>9.3f}s")
+        if args.show:
+            print(result.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()